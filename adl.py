@@ -19,15 +19,72 @@ import logging
 import sys
 import getpass
 
-from adl import login, epub_get, account, device, db, data
+from adl import data
+
+# Modules are imported by the commands using them: lxml, requests and
+# cryptography take longer to import than short commands take to run
+
+def positive_int(value):
+  # Worker counts: with none, nothing would ever run
+  number = int(value)
+  if number < 1:
+    raise argparse.ArgumentTypeError("must be at least 1, got {}".format(value))
+  return number
+
+def configure_network(args):
+  from adl import transport, api_call
+  from adl.retry import RetryPolicy
+  from adl.throttle import Throttle, DEFAULT_HOST_CONCURRENCY
+
+  def option(value, default):
+    return value if value is not None else default
+
+  throttle = Throttle(max_concurrency=option(args.host_concurrency, DEFAULT_HOST_CONCURRENCY), rate=args.host_rate)
+  transport.configure(pool_maxsize=option(args.pool_size, transport.DEFAULT_POOL_MAXSIZE),
+                      timeout=tuple(option(args.timeout, transport.DEFAULT_TIMEOUT)), throttle=throttle)
+  if args.retries is not None:
+    api_call.APICall.retry_policy = RetryPolicy(attempts=args.retries + 1)
 
 def adobe_login(args):
+  from adl import login
+  configure_network(args)
+
+  if args.batch is not None:
+    batch_login(args)
+    return
+
   password = None
   if args.user is not None:
     password = getpass.getpass()
 
   login.login(args.user, password)
 
+def batch_login(args):
+  from adl import login, aio
+  credentials = login.read_credentials(args.batch)
+  if len(credentials) == 0:
+    logging.error("No credentials found in {}".format(args.batch))
+    sys.exit(1)
+
+  if args.workers > aio.DEFAULT_MAX_WORKERS:
+    aio.configure(max_workers=args.workers)
+
+  results = login.login_batch(credentials, args.workers, args.key_workers)
+
+  print("Summary:")
+  failed = 0
+  for user, acc in results:
+    name = user if user is not None else "anonymous"
+    if acc is None:
+      failed += 1
+      print("- FAILED {}".format(name))
+    else:
+      print("- OK     {} -> {}".format(name, acc.urn))
+  print("{} accounts created, {} failed".format(len(results) - failed, failed))
+
+  if failed > 0:
+    sys.exit(1)
+
 def list_accounts(args):
   print("Accounts (* shows currently used account):")
   for a in data.accounts:
@@ -37,13 +94,59 @@ def list_accounts(args):
     print(("- {} {} - {} ({})".format(marker, a.urn, a.sign_id, a.sign_method)))
 
 def delete_account(args):
+  from adl import account
   account.account_delete(args.urn)
 
 def set_default_account(args):
+  from adl import account
   account.set_default_account(args.urn)
 
+def export_accounts(args):
+  from adl import account
+  account.account_export(args.filename)
+
+def import_accounts(args):
+  from adl import account
+  if account.account_import(args.filename) is None:
+    sys.exit(1)
+
 def get_ebook(args):
-  epub_get.get_ebook(args.filename)
+  from adl import epub_get, aio
+  configure_network(args)
+
+  sources = []
+  for f in args.filenames:
+    if f == '-':
+      sources.extend([l.strip() for l in sys.stdin if l.strip() != ''])
+    else:
+      sources.append(f)
+
+  filenames = epub_get.find_acsm_files(sources)
+  if len(filenames) == 0:
+    logging.error("No ACSM file found")
+    sys.exit(1)
+
+  if args.auth_ttl is not None:
+    epub_get.auth_ttl = args.auth_ttl
+  epub_get.skip_downloaded = not args.force
+
+  if args.workers > aio.DEFAULT_MAX_WORKERS:
+    aio.configure(max_workers=args.workers)
+
+  results = epub_get.get_ebooks(filenames, args.workers, args.deadline)
+
+  print("Summary:")
+  failed = 0
+  for acsm, epub in results:
+    if epub is None:
+      failed += 1
+      print("- FAILED {}".format(acsm))
+    else:
+      print("- OK     {} -> {}".format(acsm, epub))
+  print("{} downloaded, {} failed".format(len(results) - failed, failed))
+
+  if failed > 0:
+    sys.exit(1)
 
 def list_devices(args):
   print("Known devices:")
@@ -55,18 +158,35 @@ def list_devices(args):
     print("No registered device")
 
 def register_device(args):
+  from adl import device
+  configure_network(args)
   device.device_register(args.mountpoint)
 
 parser = argparse.ArgumentParser(description='Manipulate ACSM files')
 parser.add_argument('-v', '--verbose', dest="verbose", help="Log verbosely", action="store_true", default=False)
+parser.add_argument('--timeout', dest="timeout", type=float, nargs=2, metavar=("CONNECT", "READ"), default=None, help="Connect and read timeouts of network requests, in seconds")
+parser.add_argument('--retries', dest="retries", type=int, default=None, help="Number of retries of a failed request")
+parser.add_argument('--host-concurrency', dest="host_concurrency", type=int, default=None, help="Maximum number of requests in flight to a single host")
+parser.add_argument('--host-rate', dest="host_rate", type=float, default=None, help="Maximum number of requests per second to a single host")
+parser.add_argument('--data-dir', dest="data_dir", default=None, help="Data directory (default: $ADL_DATA_DIR or ~/.adl)")
+parser.add_argument('--tenant', dest="tenant", default=None, help="Use the data of this tenant, in its own directory under the data directory (default: $ADL_TENANT)")
+parser.add_argument('--shards', dest="shards", type=int, default=None, help="Spread the accounts over this many databases, when creating a data directory (default: $ADL_SHARDS or 0)")
+parser.add_argument('--pool-size', dest="pool_size", type=int, default=None, help="Number of kept-alive connections per host")
 subparsers = parser.add_subparsers(title="commands", description="available commands", help="additional help")
 
 parser_get = subparsers.add_parser('get', help='Download ebook from an ACSM file')
-parser_get.add_argument('-f', '--filename', dest="filename", required=True, help='The ACSM file')
+parser_get.add_argument('-f', '--filename', dest="filenames", required=True, nargs='+', help='ACSM files, directories or glob patterns ("-" reads a list from stdin)')
+parser_get.add_argument('-j', '--workers', dest="workers", type=positive_int, default=4, help='Number of books downloaded concurrently')
+parser_get.add_argument('--auth-ttl', dest="auth_ttl", type=int, default=None, help='Seconds during which an authentication to an operator is reused (0 to disable, default: 1 hour)')
+parser_get.add_argument('--deadline', dest="deadline", type=float, default=None, help='Give up on a book after this many seconds')
+parser_get.add_argument('--force', dest="force", action="store_true", default=False, help='Download books again, even if they were already downloaded from the same ACSM')
 parser_get.set_defaults(func=get_ebook)
 
 parser_login = subparsers.add_parser('login', help='Login to Content Server')
 parser_login.add_argument('-u', '--user', dest="user", default=None, help='Login with this Adobe ID')
+parser_login.add_argument('--batch', dest="batch", default=None, help='Create the accounts listed in this file, one "<adobeID> <password>" or "anonymous" per line')
+parser_login.add_argument('-j', '--workers', dest="workers", type=positive_int, default=4, help='Number of accounts created concurrently (with --batch)')
+parser_login.add_argument('--key-workers', dest="key_workers", type=positive_int, default=None, help='Number of processes generating keys (with --batch, default: number of CPUs)')
 parser_login.set_defaults(func=adobe_login)
 
 parser_account = subparsers.add_parser('account', help='Manage accounts')
@@ -79,6 +199,12 @@ parser_adel.set_defaults(func=delete_account)
 parser_aset = account_sp.add_parser('use', help='Set account to use')
 parser_aset.add_argument('urn', help='The user urn')
 parser_aset.set_defaults(func=set_default_account)
+parser_aexport = account_sp.add_parser('export', help='export accounts, devices and configuration (contains private keys !)')
+parser_aexport.add_argument('-o', '--output', dest="filename", default="-", help='Output file, compressed if it ends with .gz (default: stdout)')
+parser_aexport.set_defaults(func=export_accounts)
+parser_aimport = account_sp.add_parser('import', help='import accounts exported by "account export"')
+parser_aimport.add_argument('filename', help='Exported file ("-" reads from stdin)')
+parser_aimport.set_defaults(func=import_accounts)
 
 parser_device = subparsers.add_parser('device', help='Manage devices for current user')
 device_sp = parser_device.add_subparsers()
@@ -88,23 +214,38 @@ parser_detect = device_sp.add_parser('register', help='Register reader')
 parser_detect.add_argument('mountpoint', help='Reader root fs mountpoint')
 parser_detect.set_defaults(func=register_device)
 
-args = parser.parse_args()
-
-if not hasattr(args, 'func'):
-  parser.print_help()
-  sys.exit(1)
+def main():
+  args = parser.parse_args()
 
-# TODO now that adl is a package:
-#   - Method should not "print" anything but return lists
-#   - Data should not go through here
-#   - module names do not really make sense
+  if not hasattr(args, 'func'):
+    parser.print_help()
+    sys.exit(1)
 
-if args.verbose:
-  loglevel = logging.DEBUG
-else:
-  loglevel = logging.INFO
-logging.basicConfig(format='%(levelname)s:%(message)s', level=loglevel)
-
-# Call appropriate handler
-args.func(args)
+  # TODO now that adl is a package:
+  #   - Method should not "print" anything but return lists
+  #   - Data should not go through here
+  #   - module names do not really make sense
 
+  if args.verbose:
+    loglevel = logging.DEBUG
+  else:
+    loglevel = logging.INFO
+  logging.basicConfig(format='%(levelname)s:%(message)s', level=loglevel)
+
+  if args.data_dir is not None or args.tenant is not None or args.shards is not None:
+    try:
+      data.configure(args.data_dir, args.shards, args.tenant)
+    except ValueError as e:
+      logging.error(e)
+      sys.exit(1)
+  # The data itself is read when a command needs it
+  if not data.check_or_create_dir():
+    logging.error("Error accessing data directory !")
+    sys.exit(1)
+
+  # Call appropriate handler
+  args.func(args)
+
+# Key generation processes may import this module again: only run as a script
+if __name__ == "__main__":
+  main()
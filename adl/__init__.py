@@ -1,9 +1,4 @@
 from . import db
 
+# Read on first use, so that commands which do not need it start fast
 data = db.DBData()
-
-if not data.check_or_create_dir():
-  logging.error("Error accessing data directory !")
-  sys.exit(1)
-
-data.load()
@@ -1,4 +1,8 @@
 import logging
+import gzip
+import json
+import os
+import sys
 
 from . import data
 
@@ -16,3 +20,53 @@ def account_delete(urn):
     logging.info("Account deleted")
 
   return True
+
+########### Export / import ############
+
+# One JSON record per line (NDJSON), gzip compressed if the file name ends with .gz
+# "-" is stdout or stdin
+def open_bundle(filename, mode):
+  if filename == "-":
+    stream = sys.stdout if mode == "w" else sys.stdin
+    return open(stream.fileno(), mode, encoding="utf-8", closefd=False)
+
+  if mode == "w":
+    # The bundle holds private keys: only we can read it
+    os.close(os.open(filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600))
+
+  if filename.endswith(".gz"):
+    return gzip.open(filename, mode + "t", encoding="utf-8")
+  return open(filename, mode, encoding="utf-8")
+
+def account_export(filename):
+  count = 0
+  with open_bundle(filename, "w") as f:
+    for record in data.export_records():
+      f.write(json.dumps(record, separators=(",", ":")))
+      f.write("\n")
+      if record["type"] == "account":
+        count += 1
+
+  logging.info("{} accounts exported".format(count))
+  return count
+
+def read_records(f):
+  for number, line in enumerate(f, 1):
+    line = line.strip()
+    if line == "":
+      continue
+    try:
+      yield json.loads(line)
+    except ValueError:
+      logging.warning("Skipping invalid record on line {}".format(number))
+
+def account_import(filename):
+  try:
+    with open_bundle(filename, "r") as f:
+      count = data.import_records(read_records(f))
+  except Exception:
+    logging.exception("Import failed, no account was imported")
+    return None
+
+  logging.info("{} accounts imported".format(count))
+  return count
@@ -0,0 +1,36 @@
+import asyncio
+import contextvars
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# requests and the signing code are blocking: the event loop hands them to
+# this pool, so its size bounds the number of exchanges really in flight
+DEFAULT_MAX_WORKERS = 100
+
+_executor = None
+_lock = threading.Lock()
+
+def configure(max_workers=DEFAULT_MAX_WORKERS):
+  global _executor
+  with _lock:
+    if _executor is not None:
+      _executor.shutdown(wait=False)
+    _executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="adl")
+  return _executor
+
+def get_executor():
+  global _executor
+  with _lock:
+    if _executor is None:
+      _executor = ThreadPoolExecutor(max_workers=DEFAULT_MAX_WORKERS, thread_name_prefix="adl")
+    return _executor
+
+async def run_blocking(func, *args):
+  # Context variables (e.g. the current deadline) follow the call in the executor
+  loop = asyncio.get_running_loop()
+  ctx = contextvars.copy_context()
+  return await loop.run_in_executor(get_executor(), functools.partial(ctx.run, func, *args))
+
+def run(coro):
+  return asyncio.run(coro)
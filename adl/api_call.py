@@ -1,43 +1,139 @@
 import logging
-import requests
 import base64
 from lxml import etree
 
-from .xml_tools import ADEPT_NS, NSMAP, sign_xml, add_subelement, get_error
+from .xml_tools import ADEPT_NS, NSMAP, sign_xml, add_subelement, get_error_code, TRANSIENT_ERRORS, \
+  parse_xml, adept_path, select, select_text, get_root_error
 from . import utils
+from .keycache import key_cache
+from .transport import get_transport
+from .aio import run_blocking
+from .retry import RetryPolicy, limit_timeout, is_transient_exception
+
+class AuthError(Exception):
+  pass
 
 class APICall:
+  # Transport shared by all calls, unless set on a subclass or an instance
+  transport = None
+  retry_policy = RetryPolicy()
+  # Whether sending the same request twice is harmless
+  idempotent = False
+  # ADEPT errors fixed by building the request again: only for requests with
+  # their own nonce and expiration. Any other error is permanent (e.g. an
+  # expired request is an expired ACSM for Fulfillment)
+  transient_errors = []
+
   def __init__(self):
     self.method = "post"
+    self.error = None
+    # Request built in advance, see prepare_async
+    self.content = None
+    # Last reply and its parsed form
+    self.reply = None
+    self.reply_root = None
+
+  def get_transport(self):
+    if self.transport is not None:
+      return self.transport
+    return get_transport()
 
   def call(self):
-    content = self.build()
-    url = self.get_url()
-
-    reply = self.send(url, content)
+    return self.parse(self.exchange())
 
+  async def call_async(self):
+    # Building signs the request (CPU bound) and sending blocks on the socket:
+    # both run in the executor so that many calls can share one event loop
+    reply = await run_blocking(self.exchange)
     return self.parse(reply)
 
-  def send(self, url, data_str):
-    headers = {'Content-type': 'application/vnd.adobe.adept+xml', 'charset':'utf-8'}
-    logging.debug(data_str)
-
+  async def prepare_async(self):
+    # Builds (and signs) the request ahead of time, e.g. while a previous
+    # request is on the wire
     try:
-      if self.method == "post":
-        r = requests.post(url, data=data_str, headers=headers)
-      elif self.method == "get":
-        r = requests.get(url)
-      r.raise_for_status()
-      reply = r.text
+      self.content = await run_blocking(self.build)
     except Exception:
-      logging.exception("Error when targeting {}".format(url))
+      logging.debug("Could not prepare request, it will be built when sent", exc_info=True)
+      self.content = None
+
+  def get_root(self, reply):
+    # The reply is parsed once, for the error check and then by parse
+    if reply is not self.reply or self.reply_root is None:
+      self.reply_root = parse_xml(reply)
+      self.reply = reply
+    return self.reply_root
+
+  def get_reply_error_code(self, reply):
+    if reply is None:
       return None
+    try:
+      return get_error_code(self.get_root(reply))
+    except (etree.XMLSyntaxError, ValueError, TypeError):
+      return None
+
+  def exchange(self):
+    url = self.get_url()
+    attempt = 0
+
+    while True:
+      if attempt == 0 and self.content is not None:
+        content = self.content
+      else:
+        content = self.build()
+      reply = self.send(url, content)
+
+      # Some ADEPT errors can be fixed by a new request (new nonce, expiration...)
+      code = self.get_reply_error_code(reply)
+      if code not in self.transient_errors or not self.retry_policy.can_retry(attempt):
+        return reply
+
+      delay = self.retry_policy.wait(attempt)
+      logging.warning("{} returned {}, retried after {:.1f}s".format(url, code, delay))
+      attempt += 1
+
+  def get_timeout(self, transport):
+    # Never wait beyond the deadline of the current operation
+    return limit_timeout(transport.timeout)
+
+  def request(self, url, data_str):
+    headers = {'Content-type': 'application/vnd.adobe.adept+xml', 'charset':'utf-8'}
+    transport = self.get_transport()
+    timeout = self.get_timeout(transport)
+
+    if self.method == "post":
+      r = transport.post(url, data=data_str, headers=headers, timeout=timeout)
+    elif self.method == "get":
+      r = transport.get(url, timeout=timeout)
+    r.raise_for_status()
+    return r.text
+
+  def send(self, url, data_str):
+    logging.debug(data_str)
+    attempt = 0
+
+    while True:
+      try:
+        reply = self.request(url, data_str)
+        break
+      except Exception as e:
+        if not is_transient_exception(e, self.idempotent) or not self.retry_policy.can_retry(attempt):
+          logging.exception("Error when targeting {}".format(url))
+          return None
+        try:
+          delay = self.retry_policy.wait(attempt)
+        except Exception:
+          logging.exception("Error when targeting {}".format(url))
+          return None
+        logging.warning("Error when targeting {} ({}), retried after {:.1f}s".format(url, e, delay))
+        attempt += 1
 
     logging.debug(reply)
     return reply
 
 ###################################
 class FFAuth(APICall):
+  idempotent = True
+
   def __init__(self, operator, acc, config):
     APICall.__init__(self)
     self.acc = acc
@@ -48,10 +144,16 @@ class FFAuth(APICall):
     return "{}/Auth".format(self.operator)
 
   def build(self):
+    # The request is not signed and has no nonce: it is the same for every book
+    dev = self.acc.get_device('local')
+    key = (self.acc.urn, "ffauth", self.acc.pkcs12, dev.device_key,
+           self.acc.licenseCertificate, self.config.authentication_certificate)
+    return key_cache.get(key, lambda: self.build_credentials(dev))
+
+  def build_credentials(self, dev):
     ff = etree.Element("{%s}credentials" % ADEPT_NS, nsmap=NSMAP)
     add_subelement(ff, "user", self.acc.urn)
 
-    dev = self.acc.get_device('local')
     certificate = utils.extract_cert_from_pkcs12(self.acc, dev.device_key)
 
     add_subelement(ff, "certificate", base64.b64encode(certificate))
@@ -64,13 +166,17 @@ class FFAuth(APICall):
     
 ###################################
 class InitLicense(APICall):
+  URL = "http://adeactivate.adobe.com/adept/InitLicenseService"
+  idempotent = True
+  transient_errors = TRANSIENT_ERRORS
+
   def __init__(self, operator, acc):
     APICall.__init__(self)
     self.acc = acc
     self.operator = operator
 
   def get_url(self):
-    return "http://adeactivate.adobe.com/adept/InitLicenseService"
+    return self.URL
 
   def build(self):
     ff = etree.Element("{%s}licenseServiceRequest" % ADEPT_NS, nsmap=NSMAP, attrib = {"identity": "user"})
@@ -90,6 +196,11 @@ class InitLicense(APICall):
 
 ###################################
 class Fulfillment(APICall):
+  RESOURCE_ITEM_INFO = adept_path("fulfillmentResult/resourceItemInfo")
+  LICENSE_TOKEN = adept_path("licenseToken")
+  SRC = adept_path("src")
+  TITLE = adept_path("metadata/dc:title")
+
   def __init__(self, acsm_content, acc, operator):
     APICall.__init__(self)
     self.acc = acc
@@ -120,23 +231,24 @@ class Fulfillment(APICall):
     if ff_reply is None:
       return (None, None, None)
 
-    if 'error' in ff_reply:
-      error = get_error(ff_reply)
-      logging.error(error)
+    tree_root = self.get_root(ff_reply)
+    self.error = get_root_error(tree_root)
+    if self.error is not None:
+      logging.error(self.error)
       return None, None, None
 
-    tree_root = etree.fromstring(ff_reply)
-    ff = tree_root.find("{http://ns.adobe.com/adept}fulfillmentResult")
-    rii = ff.find("{http://ns.adobe.com/adept}resourceItemInfo")
-    license = rii.find("{http://ns.adobe.com/adept}licenseToken")
-    ebook_url = rii.find("{http://ns.adobe.com/adept}src").text
-    metadata = rii.find("{http://ns.adobe.com/adept}metadata")
-    title = metadata.find("{http://purl.org/dc/elements/1.1/}title").text
+    rii = select(self.RESOURCE_ITEM_INFO, tree_root)
+    license = select(self.LICENSE_TOKEN, rii)
+    ebook_url = select_text(self.SRC, rii)
+    title = select_text(self.TITLE, rii)
 
     return (title, ebook_url, license)
 
 ###################################
 class Activate(APICall):
+  DEVICE = adept_path("device")
+  transient_errors = TRANSIENT_ERRORS
+
   def __init__(self, acc, dev):
     APICall.__init__(self)
     self.acc = acc
@@ -166,12 +278,17 @@ class Activate(APICall):
     if reply is None:
       return None
 
-    tree_root = etree.fromstring(reply)
-    self.device.device_id = tree_root.find("{http://ns.adobe.com/adept}device").text
+    tree_root = self.get_root(reply)
+    self.device.device_id = select_text(self.DEVICE, tree_root)
     return reply  
 
 ###################################
 class ActivationInit(APICall):
+  idempotent = True
+  AUTH_URL = adept_path("authURL")
+  USERINFO_URL = adept_path("userInfoURL")
+  CERTIFICATE = adept_path("certificate")
+
   def __init__(self):
     APICall.__init__(self)
     self.method = "get"
@@ -187,14 +304,17 @@ class ActivationInit(APICall):
     if reply is None:
       return (None, None, None)
 
-    tree_root = etree.fromstring(reply)
-    auth_url = tree_root.find("{http://ns.adobe.com/adept}authURL").text
-    userinfo_url = tree_root.find("{http://ns.adobe.com/adept}userInfoURL").text
-    activation_certificate = tree_root.find("{http://ns.adobe.com/adept}certificate").text
+    tree_root = self.get_root(reply)
+    auth_url = select_text(self.AUTH_URL, tree_root)
+    userinfo_url = select_text(self.USERINFO_URL, tree_root)
+    activation_certificate = select_text(self.CERTIFICATE, tree_root)
     return auth_url, userinfo_url, activation_certificate
 
 ###################################
 class AuthenticationInit(APICall):
+  idempotent = True
+  CERTIFICATE = adept_path("certificate")
+
   def __init__(self):
     APICall.__init__(self)
     self.method = "get"
@@ -210,12 +330,17 @@ class AuthenticationInit(APICall):
     if reply is None:
       return None
 
-    tree_root = etree.fromstring(reply)
-    auth_certificate = tree_root.find("{http://ns.adobe.com/adept}certificate").text
+    tree_root = self.get_root(reply)
+    auth_certificate = select_text(self.CERTIFICATE, tree_root)
     return auth_certificate
 
 ###################################
 class SignInDirect(APICall):
+  USER = adept_path("user")
+  PKCS12 = adept_path("pkcs12")
+  ENCRYPTED_PRIVATE_LICENSE_KEY = adept_path("encryptedPrivateLicenseKey")
+  LICENSE_CERTIFICATE = adept_path("licenseCertificate")
+
   def __init__(self, method, auth_data, akp, lkp):
     APICall.__init__(self)
     self.sign_method = method
@@ -240,14 +365,14 @@ class SignInDirect(APICall):
     if reply is None:
       return False, None, None, None, None
 
-    if 'error' in reply:
-      error = get_error(reply)
-      logging.error(error)
+    tree_root = self.get_root(reply)
+    self.error = get_root_error(tree_root)
+    if self.error is not None:
+      logging.error(self.error)
       return False, None, None, None, None
 
-    tree_root = etree.fromstring(reply)
-    user = tree_root.find("{http://ns.adobe.com/adept}user").text
-    pkcs12 = tree_root.find("{http://ns.adobe.com/adept}pkcs12").text
-    epk = tree_root.find("{http://ns.adobe.com/adept}encryptedPrivateLicenseKey").text
-    lcert = tree_root.find("{http://ns.adobe.com/adept}licenseCertificate").text
+    user = select_text(self.USER, tree_root)
+    pkcs12 = select_text(self.PKCS12, tree_root)
+    epk = select_text(self.ENCRYPTED_PRIVATE_LICENSE_KEY, tree_root)
+    lcert = select_text(self.LICENSE_CERTIFICATE, tree_root)
     return (True, user, pkcs12, epk, lcert)
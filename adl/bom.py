@@ -4,7 +4,7 @@ import hashlib
 import platform
 import subprocess
 
-from . import utils
+from .keycache import key_cache
 
 class Config():
   def __init__(self):
@@ -19,6 +19,10 @@ class Config():
     return self.activation_certificate is not None and self.authentication_certificate is not None
 
 class Account():
+  # Many accounts can be loaded at once: no per-instance __dict__
+  __slots__ = ("sign_method", "sign_id", "device_key", "auth_key", "license_key", "urn",
+               "pkcs12", "encryptedPK", "licenseCertificate", "authentication_certificate", "devices")
+
   def __init__(self):
     self.sign_method = None
     self.sign_id = None
@@ -43,9 +47,12 @@ class Account():
     return '\n'.join([sign, auth, license, pkcs12, epk, lc, auth_cert])
 
   def get_private_key(self):
+    # utils imports cryptography, which short commands do not need
+    from . import utils
     d = self.get_device('local')
-    pk = utils.aes_decrypt(base64.b64decode(self.encryptedPK), base64.b64decode(d.device_key))
-    return pk
+    def decrypt():
+      return utils.aes_decrypt(base64.b64decode(self.encryptedPK), base64.b64decode(d.device_key))
+    return key_cache.get((self.urn, "license_key", self.encryptedPK, d.device_key), decrypt)
 
   def get_device(self, device_name):
     for d in self.devices:
@@ -54,6 +61,8 @@ class Account():
     return None
 
 class Device():
+  __slots__ = ("name", "device_key", "device_id", "fingerprint", "type")
+
   def __init__(self):
     self.name = None
     self.device_key = None
@@ -91,3 +100,28 @@ class Device():
   def __str__(self):
     return "{}: {} ({})".format(self.name, self.type, self.fingerprint)
 
+
+class FulfillmentRecord():
+  # A book fulfilled for an account, identified by the resource and the
+  # transaction of its ACSM
+  # stage is the last step finished, filename the file it produced
+  FULFILLED = "fulfilled"
+  DOWNLOADED = "downloaded"
+  DONE = "done"
+
+  def __init__(self):
+    self.urn = None
+    self.resource = None
+    self.transaction = None
+    self.operator = None
+    self.title = None
+    self.src = None
+    self.license_token = None
+    self.filename = None
+    self.size = None
+    self.sha256 = None
+    self.fulfilled_at = None
+    self.stage = None
+
+  def __str__(self):
+    return "{} ({} {}) {} -> {}".format(self.title, self.resource, self.transaction, self.stage, self.filename)
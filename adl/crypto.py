@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import threading
+
 from ctypes import CDLL, POINTER, c_char_p, c_int, c_long, \
   Structure, create_string_buffer, cast
 from ctypes.util import find_library
 
-libcrypto = find_library('crypto')
+from cryptography.hazmat.primitives import serialization
 
-if libcrypto is None:
-  raise Exception('libcrypto not found')
-libcrypto = CDLL(libcrypto)
+from .keycache import KeyCache, key_cache
 
 RSA_PKCS1_PADDING = 1
 
@@ -20,58 +20,128 @@ class RSA(Structure):
   pass
 RSA_p = POINTER(RSA)
 
-def F(restype, name, argtypes):
-  func = getattr(libcrypto, name)
-  func.restype = restype
-  func.argtypes = argtypes
-  return func
+class LibCrypto:
+  # libcrypto is looked up on first use: find_library runs external tools
+  def __init__(self, path):
+    lib = CDLL(path)
+
+    def F(restype, name, argtypes):
+      func = getattr(lib, name)
+      func.restype = restype
+      func.argtypes = argtypes
+      return func
+
+    self.d2i_RSAPrivateKey = F(RSA_p, 'd2i_RSAPrivateKey',
+                        [RSA_p, c_char_pp, c_long])
+    self.RSA_size = F(c_int, 'RSA_size', [RSA_p])
+    self.RSA_private_encrypt = F(c_int, 'RSA_private_encrypt',
+                          [c_int, c_char_p, c_char_p, RSA_p, c_int])
+    self.RSA_private_decrypt = F(c_int, 'RSA_private_decrypt',
+                          [c_int, c_char_p, c_char_p, RSA_p, c_int])
+    self.RSA_free = F(None, 'RSA_free', [RSA_p])
+
+    self.ERR_get_error = F(c_long, 'ERR_get_error', [])
+    self.ERR_error_string = F(c_char_p, 'ERR_error_string', [c_long, c_char_p])
 
-d2i_RSAPrivateKey = F(RSA_p, 'd2i_RSAPrivateKey',
-                    [RSA_p, c_char_pp, c_long])
-RSA_size = F(c_int, 'RSA_size', [RSA_p])
-RSA_private_encrypt = F(c_int, 'RSA_private_encrypt',
-                      [c_int, c_char_p, c_char_p, RSA_p, c_int])
-RSA_private_decrypt = F(c_int, 'RSA_private_decrypt',
-                      [c_int, c_char_p, c_char_p, RSA_p, c_int])
-RSA_free = F(None, 'RSA_free', [RSA_p])
+  def error(self):
+    err = create_string_buffer(256)
+    return self.ERR_error_string(self.ERR_get_error(), err)
 
-ERR_get_error = F(c_long, 'ERR_get_error', [])
-ERR_error_string = F(c_char_p, 'ERR_error_string', [c_long, c_char_p])
+_libcrypto = None
+_libcrypto_resolved = False
+_lock = threading.Lock()
+
+def get_libcrypto():
+  # Returns None if libcrypto cannot be used
+  global _libcrypto, _libcrypto_resolved
+  with _lock:
+    if not _libcrypto_resolved:
+      _libcrypto_resolved = True
+      path = find_library('crypto')
+      if path is not None:
+        try:
+          _libcrypto = LibCrypto(path)
+        except (OSError, AttributeError):
+          _libcrypto = None
+    return _libcrypto
 
 class RSAHandler(object):
   def __init__(self, der):
+      self._rsa = None
+      self.lib = get_libcrypto()
+      if self.lib is None:
+        raise Exception('libcrypto not found')
       buf = create_string_buffer(der)
       pp = c_char_pp(cast(buf, c_char_p))
-      rsa = self._rsa = d2i_RSAPrivateKey(None, pp, len(der))
+      rsa = self._rsa = self.lib.d2i_RSAPrivateKey(None, pp, len(der))
       if rsa is None:
-          raise ADEPTError('Error parsing ADEPT user key DER')
+          raise Exception('Error parsing ADEPT user key DER')
+      self.size = self.lib.RSA_size(rsa)
 
   def encrypt(self, from_):
-      rsa = self._rsa
-      to = create_string_buffer(RSA_size(rsa))
-      tolen = c_int();
-      result = RSA_private_encrypt(len(from_), from_, to, rsa, RSA_PKCS1_PADDING)
+      to = create_string_buffer(self.size)
+      result = self.lib.RSA_private_encrypt(len(from_), from_, to, self._rsa, RSA_PKCS1_PADDING)
       if result == -1:
-        err = create_string_buffer(256)
-        err = ERR_error_string(ERR_get_error(), err)
-        print(err)
-        raise Exception('RSA encryption failed')
-      return to
+        raise Exception('RSA encryption failed: {}'.format(self.lib.error()))
+      return to.raw[:result]
 
   def decrypt(self, from_):
-      rsa = self._rsa
-      to = create_string_buffer(RSA_size(rsa))
-      tolen = c_int();
-      result = RSA_private_decrypt(len(from_), from_, to, rsa, RSA_PKCS1_PADDING)
+      to = create_string_buffer(self.size)
+      result = self.lib.RSA_private_decrypt(len(from_), from_, to, self._rsa, RSA_PKCS1_PADDING)
       if result == -1:
-        err = create_string_buffer(256)
-        err = ERR_error_string(ERR_get_error(), err)
-        print(err)
-        raise Exception('RSA decryption failed')
-      return to
+        raise Exception('RSA decryption failed: {}'.format(self.lib.error()))
+      return to.raw[:result]
 
   def __del__(self):
       if self._rsa is not None:
-          RSA_free(self._rsa)
+          self.lib.RSA_free(self._rsa)
           self._rsa = None
 
+class PythonRSAHandler(object):
+  # Same operation as RSAHandler.encrypt, from the key numbers parsed by
+  # cryptography, which does not expose the raw private key operation
+  # Only used when libcrypto is not available: this CRT computation with
+  # Python integers is not constant-time, and may leak the key through timing
+  def __init__(self, der):
+    numbers = serialization.load_der_private_key(der, password=None).private_numbers()
+    self.p = numbers.p
+    self.q = numbers.q
+    self.dmp1 = numbers.dmp1
+    self.dmq1 = numbers.dmq1
+    self.iqmp = numbers.iqmp
+    self.size = (numbers.public_numbers.n.bit_length() + 7) // 8
+
+  def encrypt(self, from_):
+    # PKCS#1 v1.5 padding, block type 1
+    if len(from_) > self.size - 11:
+      raise Exception('RSA encryption failed: data too large for key size')
+    em = b"\x00\x01" + b"\xff" * (self.size - 3 - len(from_)) + b"\x00" + bytes(from_)
+    m = int.from_bytes(em, "big")
+
+    # CRT
+    m1 = pow(m, self.dmp1, self.p)
+    m2 = pow(m, self.dmq1, self.q)
+    h = (self.iqmp * (m1 - m2)) % self.p
+    return (m2 + h * self.q).to_bytes(self.size, "big")
+
+class Signer(object):
+  # Holds a parsed private key, to sign many digests with it
+  def __init__(self, der):
+    if get_libcrypto() is not None:
+      self.handler = RSAHandler(der)
+    else:
+      self.handler = PythonRSAHandler(der)
+
+  def sign(self, digest):
+    return self.handler.encrypt(digest)
+
+  def sign_many(self, digests):
+    return [self.handler.encrypt(d) for d in digests]
+
+# Keyed by private key: cleared with the key cache, e.g. when an account is deleted
+_signers = KeyCache()
+key_cache.derived.append(_signers)
+
+def get_signer(der):
+  der = bytes(der)
+  return _signers.get((der,), lambda: Signer(der))
@@ -1,98 +1,418 @@
 import sqlite3
 import os
 import logging
+import time
+import threading
+import contextlib
+import atexit
+import hashlib
 
-from .bom import Account, Config, Device
+from .bom import Account, Config, Device, FulfillmentRecord
+from .keycache import key_cache
+from .retry import RetryPolicy
+
+# The data directory can be set by environment variable (or option, see adl.py)
+DATA_DIR_ENV = "ADL_DATA_DIR"
+TENANT_ENV = "ADL_TENANT"
+SHARDS_ENV = "ADL_SHARDS"
 
 class DBData:
-  def __init__(self):
-    self.config = None
-    self.accounts = []
-    self.db = DB()
-    self.db_path = "{}/.adl".format(os.environ["HOME"])
+  def __init__(self, data_dir=None, shards=None, tenant=None):
+    self.db = None
+    self.shards = {}
+    self.configure(data_dir, shards, tenant)
+
+  def configure(self, data_dir=None, shards=None, tenant=None):
+    # Arguments come first, then the environment, then ~/.adl
+    # Each tenant has its own directory, so its own databases and write locks
+    if data_dir is None:
+      data_dir = os.environ.get(DATA_DIR_ENV) or "{}/.adl".format(os.environ["HOME"])
+    if tenant is None:
+      tenant = os.environ.get(TENANT_ENV) or None
+    if tenant is not None:
+      if tenant in ["", ".", ".."] or "/" in tenant or os.sep in tenant:
+        raise ValueError("Invalid tenant name: {}".format(tenant))
+      data_dir = os.path.join(data_dir, "tenants", tenant)
+    if shards is None:
+      shards = int(os.environ.get(SHARDS_ENV) or 0)
+
+    self.close()
+    self.db_path = data_dir
     self.db_file = 'adl.db'
+    self.requested_shards = shards
+    # 0: accounts are stored in the main database
+    # The actual number is read from the data directory by load
+    self.shard_count = 0
+    self.db = DB(self.db_path, self.db_file)
+    self.shards = {}
+    # Shards whose accounts and sessions are in memory, None is the main database
+    self.loaded_shards = {None}
+
+    # Nothing is read until it is needed, see ensure_loaded
+    self.loaded = False
+    self._config = None
+    self._auth_sessions = {}
+    self.index_accounts([])
+
+  def close(self):
+    if self.db is not None:
+      self.db.close()
+    for db in self.shards.values():
+      db.close()
+
+  def ensure_loaded(self):
+    if not self.loaded:
+      self.load()
+
+  # Data set explicitly is not loaded again
+  @property
+  def config(self):
+    self.ensure_loaded()
+    return self._config
+
+  @config.setter
+  def config(self, config):
+    self.loaded = True
+    self._config = config
+
+  # (urn, operator) -> time of the authentication
+  @property
+  def auth_sessions(self):
+    self.ensure_loaded()
+    return self._auth_sessions
+
+  @auth_sessions.setter
+  def auth_sessions(self, sessions):
+    self.loaded = True
+    self._auth_sessions = sessions
+
+  # Lookups go through dict indexes, rebuilt when the account list is replaced
+  @property
+  def accounts(self):
+    # Every shard is loaded: find_account_by_urn only loads the one it needs
+    self.load_all_shards()
+    return self._accounts
+
+  @accounts.setter
+  def accounts(self, accounts):
+    self.loaded = True
+    self.index_accounts(accounts)
+
+  def index_accounts(self, accounts):
+    self._accounts = accounts
+    self.accounts_by_urn = {}
+    self.accounts_by_sign = {}
+    self.devices_by_fingerprint = {}
+    for a in accounts:
+      self.index_account(a)
+
+  def index_account(self, a):
+    self.accounts_by_urn.setdefault(a.urn, a)
+    self.accounts_by_sign.setdefault(a.sign_id, a)
+    for d in a.devices:
+      self.devices_by_fingerprint.setdefault((a.urn, d.fingerprint), d)
 
   def check_or_create_dir(self):
     if os.path.exists(self.db_path):
       if os.path.isdir(self.db_path):
           return True
       else:
-        logging.error("{} is not a directory, please remove it and try again")
+        logging.error("{} is not a directory, please remove it and try again".format(self.db_path))
         return False
     else:
-      logging.info("~/.adl/ does not exist: creating it")
-      os.mkdir(self.db_path)
+      logging.info("{} does not exist: creating it".format(self.db_path))
+      os.makedirs(self.db_path)
 
     return True
 
+  ########### Shards ############
+
+  # Accounts, their devices and sessions can be spread over several
+  # databases in <data dir>/shards, by hash of the account urn
+  # The configuration (and current account) stays in the main database
+  def shard_ids(self):
+    # The number of shards is only known once the main database is read
+    self.ensure_loaded()
+    if self.shard_count == 0:
+      return [None]
+    return list(range(self.shard_count))
+
+  def shard_of(self, urn):
+    self.ensure_loaded()
+    if self.shard_count == 0:
+      return None
+    digest = hashlib.sha1(urn.encode("utf-8")).digest()
+    return int.from_bytes(digest[:4], "big") % self.shard_count
+
+  def shard_db(self, shard):
+    # Shard databases are opened on first use
+    if shard is None:
+      return self.db
+    db = self.shards.get(shard)
+    if db is None:
+      path = os.path.join(self.db_path, "shards")
+      os.makedirs(path, mode=0o700, exist_ok=True)
+      db = DB(path, "adl-{:03d}.db".format(shard))
+      self.shards[shard] = db
+    return db
+
+  def resolve_shards(self):
+    # The number of shards is fixed when the data directory is first sharded:
+    # accounts would not be found in their shard if it changed
+    stored = self.db.get_setting("shards")
+    if stored is None and self.requested_shards > 0:
+      with self.db.transaction():
+        stored = self.db.get_setting("shards")
+        if stored is None:
+          if self.db.has_accounts():
+            logging.error("Accounts are already stored in {}, not sharding it: export them, then import them in a new data directory".format(self.db_path))
+            return 0
+          self.db.set_setting("shards", self.requested_shards)
+          stored = self.requested_shards
+
+    if stored is None:
+      return 0
+    if self.requested_shards not in [0, int(stored)]:
+      logging.warning("{} uses {} shards, ignoring the requested number".format(self.db_path, stored))
+    return int(stored)
+
+  def load_shard(self, shard):
+    db = self.shard_db(shard)
+    with db.transaction(immediate=False):
+      db.changed_tables()
+      accounts = db.load_accounts()
+      sessions = db.load_auth_sessions()
+    self.replace_shard(shard, accounts, sessions)
+    self.loaded_shards.add(shard)
+
+  def replace_shard(self, shard, accounts=None, sessions=None):
+    # What we hold for the other shards is kept
+    if accounts is not None:
+      self.accounts = [a for a in self._accounts if self.shard_of(a.urn) != shard] + accounts
+    if sessions is not None:
+      kept = {k: v for k, v in self.auth_sessions.items() if self.shard_of(k[0]) != shard}
+      kept.update(sessions)
+      self.auth_sessions = kept
+
+  def ensure_shard(self, shard):
+    if shard in self.loaded_shards:
+      return
+    try:
+      self.load_shard(shard)
+    except Exception:
+      logging.exception("Exception occurred when loading accounts !")
+
+  def load_all_shards(self):
+    for shard in self.shard_ids():
+      self.ensure_shard(shard)
+
+  ########### Transactions ############
+
+  @contextlib.contextmanager
+  def logged_transaction(self, error_message, immediate=True, shard=None):
+    # Errors are logged and the changes made in the block are rolled back
+    try:
+      with self.transaction(immediate, shard):
+        yield
+    except Exception:
+      logging.exception(error_message)
+
+  @contextlib.contextmanager
+  def transaction(self, immediate=True, shard=None):
+    # Groups several changes (e.g. add_account, add_device) in one transaction
+    # of the main database, or of a shard
+    # Each database commits on its own: a block writing to a shard and to the
+    # main database is not atomic
+    # Our data is brought up to date first, other processes may have changed it
+    with self.shard_db(shard).transaction(immediate):
+      self.refresh()
+      yield
+
   def load(self):
-    self.db.connect()
+    self.loaded = True
+    if not self.check_or_create_dir():
+      logging.error("Error accessing data directory !")
+      return
     try:
-      self.config = self.db.load_config()
-      self.accounts = self.db.load_accounts()
+      self.shard_count = self.resolve_shards()
+      with self.db.transaction(immediate=False):
+        # Only what changes after this is reloaded by refresh
+        self.db.changed_tables()
+        self.config = self.db.load_config()
+        if self.shard_count == 0:
+          self.accounts = self.db.load_accounts()
+          self.auth_sessions = self.db.load_auth_sessions()
+          self.loaded_shards = {None}
+        else:
+          # Shards are loaded when an account is looked up
+          self.accounts = []
+          self.auth_sessions = {}
+          self.loaded_shards = set()
     except Exception:
       logging.exception("Exception occurred during db load !")
-    self.db.disconnect()
-
-  def set_current_account(self, account_urn):
-    self.db.connect()
 
+  def refresh(self):
+    # Reloads the tables other processes changed since we last looked
+    if not self.loaded:
+      self.load()
+      return
+    # Read in transactions: the connection is shared with the threads writing to it
+    with self.db.transaction(immediate=False):
+      changed = self.db.changed_tables()
+      if "configuration" in changed:
+        self.config = self.db.load_config()
+    for shard in list(self.loaded_shards):
+      db = self.shard_db(shard)
+      accounts = None
+      sessions = None
+      with db.transaction(immediate=False):
+        if shard is not None:
+          changed = db.changed_tables()
+        if "users" in changed or "devices" in changed:
+          accounts = db.load_accounts()
+        if "auth_sessions" in changed:
+          sessions = db.load_auth_sessions()
+      self.replace_shard(shard, accounts, sessions)
+
+  def try_refresh(self):
+    # For reads: stale data is better than no data
     try:
+      self.refresh()
+    except Exception:
+      logging.exception("Exception occurred when reloading data !")
+
+  def set_current_account(self, account_urn):
+    with self.logged_transaction("Exception occurred when setting current user !"):
       if self.find_account_by_urn(account_urn) is None:
         logging.error("Unknown user")
       else:
         self.config.current_user = account_urn
         self.db.update_current_user(account_urn)
-    except Exception:
-      logging.exception("Exception occurred when setting current user !")
-
-    self.db.disconnect()
   
   def add_account(self, a):
-    self.db.connect()
-    
-    try:
+    shard = self.shard_of(a.urn)
+    with self.logged_transaction("Exception occurred when adding an account !", shard=shard):
       if self.find_account_by_urn(a.urn) is not None:
         logging.error("Account already exists - this should not happen")
       else:
-        self.accounts.append(a)
-        self.db.add_account(a)
-    except Exception:
-      logging.exception("Exception occurred when adding an account !")
+        self._accounts.append(a)
+        self.index_account(a)
+        self.shard_db(shard).add_account(a)
+
+  def add_accounts(self, accounts):
+    # The accounts and their devices are stored in a single transaction per shard
+    by_shard = {}
+    for a in accounts:
+      by_shard.setdefault(self.shard_of(a.urn), []).append(a)
+
+    for shard, shard_accounts in by_shard.items():
+      with self.logged_transaction("Exception occurred when adding accounts !", shard=shard):
+        new_accounts = []
+        new_urns = set()
+        for a in shard_accounts:
+          if self.find_account_by_urn(a.urn) is not None or a.urn in new_urns:
+            logging.error("Account {} already exists - this should not happen".format(a.urn))
+          else:
+            new_accounts.append(a)
+            new_urns.add(a.urn)
+        self.shard_db(shard).add_accounts(new_accounts)
+        self._accounts.extend(new_accounts)
+        for a in new_accounts:
+          self.index_account(a)
+
+  def export_records(self):
+    # Configuration first, then one record per account with its devices
+    with self.db.transaction(immediate=False):
+      config = self.db.load_config_row()
+      if config is not None:
+        # The current account is local to each installation
+        config.pop("default_user", None)
+        yield {"type": "config", "config": config}
+
+      for shard in self.shard_ids():
+        db = self.shard_db(shard)
+        with db.transaction(immediate=False):
+          for user, devices in db.iter_users():
+            for d in devices:
+              d.pop("user_id", None)
+            yield {"type": "account", "user": user, "devices": devices}
+
+  def import_records(self, records, batch_size=500):
+    # Records are written in batches, in a single transaction per database
+    # Returns the number of imported accounts
+    count = 0
+    # shard -> (users, devices) not written yet
+    pending = {}
+
+    def flush(shard):
+      users, devices = pending[shard]
+      db = self.shard_db(shard)
+      db.upsert("users", "user_id", users)
+      db.upsert("devices", "device_id", [d for d in devices if d.get("device_id") is not None])
+      db.replace_unidentified_devices([d for d in devices if d.get("device_id") is None])
+      users.clear()
+      devices.clear()
+
+    with self.transaction(), contextlib.ExitStack() as shard_transactions:
+      for record in records:
+        kind = record.get("type")
+        if kind == "config":
+          if self.config is None and self.db.load_config() is None:
+            conf = Config()
+            for name in ["auth_url", "activation_certificate", "userinfo_url", "authentication_certificate"]:
+              setattr(conf, name, record["config"].get(name))
+            self.db.store_config(conf)
+        elif kind == "account":
+          user = record["user"]
+          if user.get("user_id") is None:
+            logging.warning("Skipping account without user_id")
+            continue
+          shard = self.shard_of(user["user_id"])
+          if shard not in pending:
+            shard_transactions.enter_context(self.shard_db(shard).transaction())
+            pending[shard] = ([], [])
+          users, devices = pending[shard]
+          users.append(user)
+          for d in record.get("devices", []):
+            devices.append(dict(d, user_id=user["user_id"]))
+          count += 1
+          if len(users) >= batch_size:
+            flush(shard)
+        else:
+          logging.warning("Skipping unknown record {}".format(kind))
+      for shard in pending:
+        flush(shard)
 
-    self.db.disconnect()
+    with self.db.transaction(immediate=False):
+      self.config = self.db.load_config()
+    for shard in pending:
+      self.load_shard(shard)
+    return count
 
   def delete_account(self, a):
-    self.db.connect()
-    
-    try:
-      self.accounts.remove(a)
-      self.db.delete_account(a)
-    except Exception:
-      logging.exception("Exception occurred when deleting account !")
-
-    self.db.disconnect()
+    shard = self.shard_of(a.urn)
+    with self.logged_transaction("Exception occurred when deleting account !", shard=shard):
+      self._accounts.remove(a)
+      # Deleting is rare: rebuild the indexes
+      self.accounts = self._accounts
+      self.auth_sessions = {k: v for k, v in self.auth_sessions.items() if k[0] != a.urn}
+      key_cache.invalidate(a.urn)
+      self.shard_db(shard).delete_account(a)
     
   def add_device(self, urn, d):
-    self.db.connect()
-    
-    try:
+    shard = self.shard_of(urn)
+    with self.logged_transaction("Exception occurred when adding a device !", shard=shard):
       a = self.find_account_by_urn(urn)
       if a is None:
         logging.error("Account does not exist - this should not happen")
       else:
         if d.device_id not in [dev.device_id for dev in a.devices]:
           a.devices.append(d)
-        self.db.add_device(a.urn, d)
-    except Exception:
-      logging.exception("Exception occurred when adding a device !")
-
-    self.db.disconnect()
+          self.devices_by_fingerprint.setdefault((a.urn, d.fingerprint), d)
+        self.shard_db(shard).add_device(a.urn, d)
 
   def store_config(self, conf):
-    self.db.connect()
-
-    try:
+    with self.logged_transaction("Exception occurred during db store !"):
       if self.config is not None:
         # Not possible to update for the moment
         logging.error("Config already exists - this should not happen")
@@ -100,24 +420,57 @@ class DBData:
         self.db.store_config(conf)
 
       self.config = conf
-    except Exception:
-      logging.exception("Exception occurred during db store !")
 
-    self.db.disconnect()
+  def find_fulfillment(self, urn, resource, transaction):
+    try:
+      return self.shard_db(self.shard_of(urn)).load_fulfillment(urn, resource, transaction)
+    except Exception:
+      logging.exception("Exception occurred when reading fulfillments !")
+      return None
+
+  def record_fulfillment(self, r):
+    shard = self.shard_of(r.urn)
+    with self.logged_transaction("Exception occurred when recording fulfillment !", shard=shard):
+      self.shard_db(shard).store_fulfillment(r)
+
+  def discard_fulfillment(self, urn, resource, transaction):
+    shard = self.shard_of(urn)
+    with self.logged_transaction("Exception occurred when discarding fulfillment !", shard=shard):
+      self.shard_db(shard).delete_fulfillment(urn, resource, transaction)
+
+  def is_authenticated(self, urn, operator, ttl):
+    self.ensure_shard(self.shard_of(urn))
+    self.try_refresh()
+    auth_time = self.auth_sessions.get((urn, operator))
+    return auth_time is not None and time.time() - auth_time < ttl
+
+  def set_authenticated(self, urn, operator):
+    shard = self.shard_of(urn)
+    with self.logged_transaction("Exception occurred when storing authentication !", shard=shard):
+      auth_time = time.time()
+      self.auth_sessions[(urn, operator)] = auth_time
+      self.shard_db(shard).store_auth_session(urn, operator, auth_time)
+
+  def invalidate_authentication(self, urn, operator):
+    shard = self.shard_of(urn)
+    with self.logged_transaction("Exception occurred when invalidating authentication !", shard=shard):
+      self.auth_sessions.pop((urn, operator), None)
+      self.shard_db(shard).delete_auth_session(urn, operator)
 
   def find_account_by_urn(self, urn):
-    for a in self.accounts:
-      if a.urn == urn:
-        return a
-    return None
+    self.ensure_shard(self.shard_of(urn))
+    return self.accounts_by_urn.get(urn)
 
   def find_account_by_sign(self, sign):
-    for a in self.accounts:
-      if a.sign_id == sign:
-        return a
-    return None
+    self.load_all_shards()
+    return self.accounts_by_sign.get(sign)
+
+  def find_device_by_fingerprint(self, urn, fingerprint):
+    self.ensure_shard(self.shard_of(urn))
+    return self.devices_by_fingerprint.get((urn, fingerprint))
 
   def get_current_account(self):
+    self.try_refresh()
     a = None
     if self.config is not None and self.config.current_user is not None:
       a = self.find_account_by_urn(self.config.current_user)
@@ -152,22 +505,153 @@ class DB:
                   "activation_certificate": "text",
                   "userinfo_url": "text",
                   "authentication_certificate": "text"
+                },
+                "auth_sessions": {
+                  "user_id": "text",
+                  "operator": "text",
+                  "auth_time": "real",
+                  "pk": "PRIMARY KEY (user_id, operator)"
+                },
+                "generations": {
+                  "name": "text PRIMARY KEY",
+                  "value": "integer"
+                },
+                "settings": {
+                  "name": "text PRIMARY KEY",
+                  "value": "text"
+                },
+                "fulfillments": {
+                  "user_id": "text",
+                  "resource": "text",
+                  "transaction_id": "text",
+                  "operator": "text",
+                  "title": "text",
+                  "src": "text",
+                  "license_token": "text",
+                  "filename": "text",
+                  "size": "integer",
+                  "sha256": "text",
+                  "fulfilled_at": "real",
+                  "stage": "text",
+                  "pk": "PRIMARY KEY (user_id, resource, transaction_id)"
                 }
               }
+
+  # Triggers count the changes made to these tables, so that other
+  # processes only reload the tables that changed
+  TRACKED_TABLES = ["users", "devices", "configuration", "auth_sessions"]
   
-  def __init__(self):
-    self.db_path = "{}/.adl".format(os.environ["HOME"])
-    self.db_file = 'adl.db'
+  DB_INDEXES = {
+                 "devices_user_id": "devices(user_id)",
+                 "devices_fingerprint": "devices(fingerprint)",
+                 "users_sign_id": "users(sign_id)"
+               }
+
+  # Stored in PRAGMA user_version, bumped when DB_TABLES or the migrations change
+  SCHEMA_VERSION = 6
+
+  # Other processes may hold the write lock: wait for it, then retry a few times
+  BUSY_TIMEOUT = 30
+  busy_retry_policy = RetryPolicy(attempts=5, base_delay=0.1, max_delay=2.0)
+
+  def __init__(self, db_path=None, db_file='adl.db'):
+    self.db_path = db_path if db_path is not None else "{}/.adl".format(os.environ["HOME"])
+    self.db_file = db_file
+    self.connector = None
+    # The connection is kept open for the life of the process
+    self.lock = threading.RLock()
+    self.depth = 0
+    self.failed = False
+    # Last PRAGMA data_version and table generations seen, see changed_tables
+    self.data_version = None
+    self.generations = {}
 
   def connect(self):
-    self.connector = sqlite3.connect("{}/{}".format(self.db_path, self.db_file))
-    self.connector.text_factory = str
-    self.create_tables()
-
-  def disconnect(self):
-    self.connector.commit()
-    self.connector.close()
-    self.connector = None
+    with self.lock:
+      if self.connector is not None:
+        return
+
+      # Transactions are started explicitly, see transaction
+      self.connector = sqlite3.connect("{}/{}".format(self.db_path, self.db_file),
+                                       timeout=self.BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+      self.connector.text_factory = str
+      self.connector.execute("PRAGMA journal_mode=WAL")
+      self.connector.execute("PRAGMA synchronous=NORMAL")
+      atexit.register(self.close)
+
+      if self.user_version() < self.SCHEMA_VERSION:
+        with self.transaction():
+          # Another process may have upgraded it in the meantime
+          if self.user_version() < self.SCHEMA_VERSION:
+            self.create_tables()
+            self.connector.execute("PRAGMA user_version={}".format(self.SCHEMA_VERSION))
+      elif self.user_version() > self.SCHEMA_VERSION:
+        logging.warning("Database was created by a newer version of adl")
+
+  def user_version(self):
+    return self.connector.execute("PRAGMA user_version").fetchone()[0]
+
+  def close(self):
+    with self.lock:
+      if self.connector is not None:
+        self.connector.commit()
+        self.connector.close()
+        self.connector = None
+        atexit.unregister(self.close)
+
+  def begin(self, immediate):
+    # BEGIN IMMEDIATE takes the write lock now: a read-modify-write cannot
+    # fail halfway because another process wrote in the meantime
+    statement = "BEGIN IMMEDIATE" if immediate else "BEGIN"
+    attempt = 0
+    while True:
+      try:
+        self.connector.execute(statement)
+        return
+      except sqlite3.OperationalError as e:
+        busy = "locked" in str(e) or "busy" in str(e)
+        if not busy or not self.busy_retry_policy.can_retry(attempt):
+          raise
+        delay = self.busy_retry_policy.backoff(attempt)
+        logging.warning("Database is busy, retrying in {:.1f}s".format(delay))
+        time.sleep(delay)
+        attempt += 1
+
+  @contextlib.contextmanager
+  def transaction(self, immediate=True):
+    # Nested transactions are part of the outermost one: it is committed
+    # once at the end, or rolled back if any of them failed
+    # immediate: whether the block writes, see begin
+    with self.lock:
+      self.connect()
+      if self.depth == 0:
+        self.failed = False
+        self.begin(immediate)
+      self.depth += 1
+      try:
+        yield
+      except Exception:
+        self.failed = True
+        raise
+      finally:
+        self.depth -= 1
+        if self.depth == 0:
+          if self.failed:
+            self.connector.rollback()
+          else:
+            if immediate:
+              # Our own changes do not need to be reloaded
+              self.generations = self.read_generations()
+            self.connector.commit()
+
+  def cursor(self):
+    self.connect()
+    return self.connector.cursor()
+
+  def commit(self):
+    # Changes made in a transaction are committed at its end
+    if self.depth == 0:
+      self.connector.commit()
 
   # For migration purposes
   def check_column_exists(self, table_name, col_name):
@@ -201,11 +685,63 @@ class DB:
       c.execute(cmd)
 
     # Do migrations here
-
-    self.connector.commit()
+    if not self.check_column_exists("fulfillments", "stage"):
+      # Rows of older versions are finished downloads
+      c.execute("alter table fulfillments add column stage text")
+
+    for index_name, index in self.DB_INDEXES.items():
+      c.execute("create index if not exists {} on {}".format(index_name, index))
+
+    for table_name in self.TRACKED_TABLES:
+      c.execute("insert or ignore into generations(name, value) values(?, 0)", (table_name,))
+      for operation in ["insert", "update", "delete"]:
+        c.execute("create trigger if not exists {0}_{1}_generation after {1} on {0} begin "
+                  "update generations set value = value + 1 where name = '{0}'; end".format(table_name, operation))
+
+    self.commit()
+
+  def read_generations(self):
+    return dict(self.connector.execute("select name, value from generations").fetchall())
+
+  def changed_tables(self):
+    # Tracked tables changed by other connections since the last call
+    # data_version only changes when another connection commits: usually no other query is needed
+    with self.lock:
+      self.connect()
+      version = self.connector.execute("PRAGMA data_version").fetchone()[0]
+      if version == self.data_version:
+        return []
+      first = self.data_version is None
+      self.data_version = version
+
+      generations = self.read_generations()
+      if first:
+        # Nothing was read from this database before: what we hold did not come from it
+        self.generations = generations
+        return []
+      changed = [name for name, value in generations.items() if self.generations.get(name) != value]
+      self.generations = generations
+      return changed
+
+  # Properties of the data directory, e.g. its number of shards
+  def get_setting(self, name):
+    with self.transaction(immediate=False):
+      row = self.cursor().execute("select value from settings where name=?", (name,)).fetchone()
+      return row[0] if row is not None else None
+
+  def set_setting(self, name, value):
+    c = self.cursor()
+
+    c.execute("insert or replace into settings(name, value) values(?, ?)", (name, str(value)))
+
+    self.commit()
+
+  def has_accounts(self):
+    with self.transaction(immediate=False):
+      return self.cursor().execute("select 1 from users limit 1").fetchone() is not None
 
   def load_config(self):
-    c = self.connector.cursor()
+    c = self.cursor()
 
     # Config
     rows = c.execute("select default_user, auth_url, activation_certificate, userinfo_url, authentication_certificate from configuration")
@@ -223,33 +759,64 @@ class DB:
     return conf
 
   def load_accounts(self):
-    c = self.connector.cursor()
+    c = self.cursor()
 
-    # Users
+    # Users and their devices, in a single query
     accounts = []
-    rows = c.execute("select user_id, sign_id, sign_method, auth_pub, auth_priv, license_pub, license_priv, pkcs12, eplk, license_certificate from users")
-    for user in rows.fetchall():
-      a = Account()
-      accounts.append(a)
-
-      a.urn, a.sign_id, a.sign_method, akpub, akpriv, lkpub, lkpriv, a.pkcs12, a.encryptedPK, a.licenseCertificate = user
-      a.auth_key = (akpriv, akpub)
-      a.license_key = (lkpriv, lkpub)
-      a.devices = []
-
-      # Devices
-      rows = c.execute("select device_name, device_key, device_id, fingerprint, device_type from devices where user_id=?", (a.urn,))
-      for dev in rows.fetchall():
-        d = Device()
-        d.name, device_key, d.device_id, d.fingerprint, d.type = dev
-        if device_key is not None:
-          d.device_key = device_key.encode('ascii')
-        a.devices.append(d)
+    a = None
+    rows = c.execute("select u.user_id, u.sign_id, u.sign_method, u.auth_pub, u.auth_priv, u.license_pub, u.license_priv, u.pkcs12, u.eplk, u.license_certificate, "
+                     "d.device_name, d.device_key, d.device_id, d.fingerprint, d.device_type, d.rowid "
+                     "from users u left join devices d on d.user_id = u.user_id order by u.rowid, d.rowid")
+    for row in rows:
+      user, dev = row[:10], row[10:]
+
+      if a is None or a.urn != user[0]:
+        a = Account()
+        accounts.append(a)
+
+        a.urn, a.sign_id, a.sign_method, akpub, akpriv, lkpub, lkpriv, a.pkcs12, a.encryptedPK, a.licenseCertificate = user
+        a.auth_key = (akpriv, akpub)
+        a.license_key = (lkpriv, lkpub)
+        a.devices = []
+
+      # No device for this user
+      if dev[5] is None:
+        continue
+
+      d = Device()
+      d.name, device_key, d.device_id, d.fingerprint, d.type, _ = dev
+      if device_key is not None:
+        d.device_key = device_key.encode('ascii')
+      a.devices.append(d)
 
     return accounts
 
+  def load_auth_sessions(self):
+    c = self.cursor()
+
+    sessions = {}
+    rows = c.execute("select user_id, operator, auth_time from auth_sessions")
+    for user_id, operator, auth_time in rows.fetchall():
+      sessions[(user_id, operator)] = auth_time
+
+    return sessions
+
+  def store_auth_session(self, account_urn, operator, auth_time):
+    c = self.cursor()
+
+    c.execute("insert or replace into auth_sessions(user_id, operator, auth_time) values(?, ?, ?)", (account_urn, operator, auth_time))
+
+    self.commit()
+
+  def delete_auth_session(self, account_urn, operator):
+    c = self.cursor()
+
+    c.execute("delete from auth_sessions where user_id=? and operator=?", (account_urn, operator))
+
+    self.commit()
+
   def store_config(self, conf):
-    c = self.connector.cursor()
+    c = self.cursor()
 
     values = (conf.current_user,
               conf.auth_url,
@@ -259,52 +826,151 @@ class DB:
 
     c.execute("insert into configuration (default_user, auth_url, activation_certificate, userinfo_url, authentication_certificate) values (?,?,?,?,?)", values)
 
-    self.connector.commit()
+    self.commit()
+
+  INSERT_USER = "insert into users(user_id, sign_id, sign_method, auth_pub, auth_priv, license_pub, license_priv, pkcs12, eplk, license_certificate)  values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)"
+  INSERT_DEVICE = "insert into devices(user_id, device_key, device_id, fingerprint, device_name, device_type) values(?, ?, ?, ?, ?, ?)"
+
+  def account_row(self, a):
+    return (a.urn, 
+            a.sign_id, 
+            a.sign_method, 
+            a.auth_key[1],
+            a.auth_key[0],
+            a.license_key[1],
+            a.license_key[0],
+            a.pkcs12,
+            a.encryptedPK,
+            a.licenseCertificate)
+
+  def device_row(self, account_urn, d):
+    return (account_urn,
+            d.device_key.decode('ascii'), # Base64 
+            d.device_id,
+            d.fingerprint,
+            d.name,
+            d.type)
 
   def add_account(self, a):
-    c = self.connector.cursor()
+    c = self.cursor()
+
+    c.execute(self.INSERT_USER, self.account_row(a))
 
-    ph = (a.urn, 
-          a.sign_id, 
-          a.sign_method, 
-          a.auth_key[1],
-          a.auth_key[0],
-          a.license_key[1],
-          a.license_key[0],
-          a.pkcs12,
-          a.encryptedPK,
-          a.licenseCertificate)
+    self.commit()
 
-    c.execute("insert into users(user_id, sign_id, sign_method, auth_pub, auth_priv, license_pub, license_priv, pkcs12, eplk, license_certificate)  values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", ph)
+  def add_accounts(self, accounts):
+    c = self.cursor()
 
-    self.connector.commit()
+    c.executemany(self.INSERT_USER, [self.account_row(a) for a in accounts])
+    c.executemany(self.INSERT_DEVICE, [self.device_row(a.urn, d) for a in accounts for d in a.devices])
+
+    self.commit()
 
   def delete_account(self, a):
-    c = self.connector.cursor()
+    c = self.cursor()
 
+    c.execute("delete from auth_sessions where user_id=?", (a.urn,))
+    c.execute("delete from fulfillments where user_id=?", (a.urn,))
     c.execute("delete from devices where user_id=?", (a.urn,))
     c.execute("delete from users where user_id=?", (a.urn,))
 
-    self.connector.commit()
+    self.commit()
 
   def add_device(self, account_urn, d):
-    c = self.connector.cursor()
-
-    dph = (account_urn,
-           d.device_key.decode('ascii'), # Base64 
-           d.device_id,
-           d.fingerprint,
-           d.name,
-           d.type)
+    c = self.cursor()
+
+    c.execute(self.INSERT_DEVICE, self.device_row(account_urn, d))
+
+    self.commit()
+
+  # Fulfillment ledger
+  # Not kept in memory: only the record of the ACSM being processed is read
+  def load_fulfillment(self, account_urn, resource, transaction):
+    with self.transaction(immediate=False):
+      row = self.cursor().execute("select operator, title, src, license_token, filename, size, sha256, fulfilled_at, stage from fulfillments "
+                                  "where user_id=? and resource=? and transaction_id=?", (account_urn, resource, transaction)).fetchone()
+      if row is None:
+        return None
+
+      r = FulfillmentRecord()
+      r.urn, r.resource, r.transaction = account_urn, resource, transaction
+      r.operator, r.title, r.src, r.license_token, r.filename, r.size, r.sha256, r.fulfilled_at, stage = row
+      r.stage = stage if stage is not None else FulfillmentRecord.DONE
+      return r
+
+  def store_fulfillment(self, r):
+    c = self.cursor()
+
+    c.execute("insert or replace into fulfillments(user_id, resource, transaction_id, operator, title, src, license_token, filename, size, sha256, fulfilled_at, stage) "
+              "values(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+              (r.urn, r.resource, r.transaction, r.operator, r.title, r.src, r.license_token, r.filename, r.size, r.sha256, r.fulfilled_at, r.stage))
+
+    self.commit()
+
+  def delete_fulfillment(self, account_urn, resource, transaction):
+    c = self.cursor()
+
+    c.execute("delete from fulfillments where user_id=? and resource=? and transaction_id=?", (account_urn, resource, transaction))
+
+    self.commit()
+
+  # Export and import work on raw rows, as dicts of columns
+  def iter_users(self):
+    # Yields each user with the list of its devices, without loading them all
+    with self.transaction(immediate=False):
+      user_columns = [col for col in self.DB_TABLES["users"] if col != "pk"]
+      device_columns = [col for col in self.DB_TABLES["devices"] if col != "pk"]
+      query = "select {}, {}, d.rowid from users u left join devices d on d.user_id = u.user_id order by u.rowid, d.rowid".format(
+        ", ".join("u." + col for col in user_columns), ", ".join("d." + col for col in device_columns))
+
+      user = None
+      devices = []
+      for row in self.cursor().execute(query):
+        if user is None or user["user_id"] != row[0]:
+          if user is not None:
+            yield user, devices
+          user = dict(zip(user_columns, row))
+          devices = []
+        if row[-1] is not None:
+          devices.append(dict(zip(device_columns, row[len(user_columns):-1])))
+
+      if user is not None:
+        yield user, devices
+
+  def upsert(self, table_name, key, rows):
+    # Rows already present (same key) are updated
+    columns = [col for col in self.DB_TABLES[table_name] if col != "pk"]
+    updates = ", ".join("{0}=excluded.{0}".format(col) for col in columns if col != key)
+    cmd = "insert into {} ({}) values ({}) on conflict({}) do update set {}".format(
+      table_name, ", ".join(columns), ", ".join("?" * len(columns)), key, updates)
+
+    c = self.cursor()
+    c.executemany(cmd, [tuple(row.get(col) for col in columns) for row in rows])
+
+    self.commit()
+
+  def replace_unidentified_devices(self, rows):
+    # Devices without device_id never conflict in upsert: they are matched on
+    # their account and name instead
+    columns = [col for col in self.DB_TABLES["devices"] if col != "pk"]
+    cmd = "insert into devices ({}) values ({})".format(", ".join(columns), ", ".join("?" * len(columns)))
+
+    c = self.cursor()
+    for row in rows:
+      c.execute("delete from devices where user_id=? and device_name=? and device_id is null", (row.get("user_id"), row.get("device_name")))
+      c.execute(cmd, tuple(row.get(col) for col in columns))
 
-    c.execute("insert into devices(user_id, device_key, device_id, fingerprint, device_name, device_type) values(?, ?, ?, ?, ?, ?)", dph)
+    self.commit()
 
-    self.connector.commit()
+  def load_config_row(self):
+    columns = [col for col in self.DB_TABLES["configuration"] if col != "pk"]
+    row = self.cursor().execute("select {} from configuration".format(", ".join(columns))).fetchone()
+    return dict(zip(columns, row)) if row is not None else None
 
   def update_current_user(self, account_urn):
-    c = self.connector.cursor()
+    c = self.cursor()
 
     c.execute("update configuration set default_user=?", (account_urn,))
 
-    self.connector.commit()
+    self.commit()
  
@@ -20,11 +20,9 @@ def device_register(mountpoint):
     logging.error("Please log in with a user and select it first")
 
   # Check it is not already in our db
-  devices = current_account.devices
-  for device in devices:
-    if device.fingerprint == d.fingerprint:
-      print("Device already exists in the DB")
-      return
+  if data.find_device_by_fingerprint(current_account.urn, d.fingerprint) is not None:
+    print("Device already exists in the DB")
+    return
 
   # Check if it is not already activated
   username, plk, device_id = read_activation_file(mountpoint)
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import logging
+import os
+
+try:
+  import fcntl
+except ImportError:
+  # Windows: downloads are not locked
+  fcntl = None
+
+from .transport import get_transport
+from .retry import check_deadline, limit_timeout
+
+CHUNK_SIZE = 1024 * 1024
+
+class DownloadInProgress(Exception):
+  pass
+
+# The book is downloaded in a .part file next to its destination, named after
+# what is downloaded (e.g. the resource and transaction of the ACSM) so that
+# two books with the same title do not share it. A small journal next to it
+# records where it comes from and how much of it was written, so that an
+# interrupted download can be resumed with a Range request
+def part_filenames(destination, key):
+  digest = hashlib.sha1(key.encode("utf-8")).hexdigest()[:16]
+  part_filename = os.path.join(os.path.dirname(destination), "{}.epub.part".format(digest))
+  return part_filename, "{}.json".format(part_filename)
+
+def lock_part(f, part_filename):
+  # Held while the download runs: another worker (or process) downloading the
+  # same book fails instead of writing to the same file
+  if fcntl is None:
+    return
+  try:
+    fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except BlockingIOError:
+    raise DownloadInProgress("{} is being downloaded by another worker".format(part_filename))
+
+def read_journal(journal_filename):
+  try:
+    with open(journal_filename, "r") as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+def write_journal(journal_filename, journal):
+  tmp_filename = "{}.tmp".format(journal_filename)
+  with open(tmp_filename, "w") as f:
+    json.dump(journal, f)
+  os.replace(tmp_filename, journal_filename)
+
+def discard_part(destination, key):
+  for filename in part_filenames(destination, key):
+    if os.path.exists(filename):
+      os.remove(filename)
+
+def resume_offset(url, part_filename, journal):
+  if journal is None or journal.get("url") != url or not os.path.exists(part_filename):
+    return 0
+  # Without a validator for If-Range, we could not tell whether the file changed
+  if journal.get("etag") is None and journal.get("last_modified") is None:
+    return 0
+  # Only trust what actually reached the disk
+  return min(journal.get("written", 0), os.path.getsize(part_filename))
+
+def hash_prefix(f, h, size):
+  f.seek(0)
+  remaining = size
+  while remaining > 0:
+    chunk = f.read(min(CHUNK_SIZE, remaining))
+    if not chunk:
+      break
+    h.update(chunk)
+    remaining -= len(chunk)
+
+def file_sha256(filename):
+  h = hashlib.sha256()
+  with open(filename, "rb") as f:
+    hash_prefix(f, h, os.fstat(f.fileno()).st_size)
+  return h.hexdigest()
+
+def is_intact(filename, size, sha256):
+  # The size is checked first: reading the file is only needed if it matches
+  try:
+    if os.path.getsize(filename) != size:
+      return False
+    return file_sha256(filename) == sha256
+  except OSError:
+    return False
+
+def content_range_start(r):
+  # First byte of a 206 reply, from "Content-Range: bytes <start>-<end>/<size>"
+  unit, _, rng = r.headers.get("Content-Range", "").partition(" ")
+  start = rng.partition("-")[0]
+  if unit != "bytes" or not start.isdigit():
+    return None
+  return int(start)
+
+def download_to_file(url, destination, key=None):
+  # Returns the path of the complete .part file and the SHA-256 of its content
+  # key: identifies the book downloaded, its URL by default
+  part_filename, journal_filename = part_filenames(destination, key if key is not None else url)
+  with os.fdopen(os.open(part_filename, os.O_RDWR | os.O_CREAT, 0o644), "r+b") as f:
+    lock_part(f, part_filename)
+    return download_locked(url, f, part_filename, journal_filename)
+
+def download_locked(url, f, part_filename, journal_filename):
+  journal = read_journal(journal_filename)
+  offset = resume_offset(url, part_filename, journal)
+
+  headers = {}
+  if offset > 0:
+    headers["Range"] = "bytes={}-".format(offset)
+    # The server sends the whole file if it has changed in the meantime
+    headers["If-Range"] = journal.get("etag") or journal.get("last_modified")
+
+  # A stalled read does not go beyond the deadline either
+  transport = get_transport()
+  r = transport.get(url, stream=True, headers=headers, timeout=limit_timeout(transport.timeout))
+  try:
+    if r.status_code == 416 or (r.status_code == 206 and content_range_start(r) != offset):
+      # Our partial file does not match the remote file anymore, or the
+      # server did not send the part we asked for
+      logging.info("Cannot resume download, starting over")
+      r.close()
+      offset = 0
+      r = transport.get(url, stream=True, headers={}, timeout=limit_timeout(transport.timeout))
+
+    r.raise_for_status()
+
+    if offset > 0 and r.status_code == 206:
+      logging.info("Resuming download at byte {}".format(offset))
+    else:
+      offset = 0
+
+    journal = {
+      "url": url,
+      "etag": r.headers.get("ETag"),
+      "last_modified": r.headers.get("Last-Modified"),
+      "written": offset
+    }
+
+    h = hashlib.sha256()
+    if offset > 0:
+      hash_prefix(f, h, offset)
+    f.seek(offset)
+    f.truncate()
+    write_journal(journal_filename, journal)
+
+    for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+      check_deadline()
+      f.write(chunk)
+      h.update(chunk)
+      f.flush()
+      journal["written"] += len(chunk)
+      write_journal(journal_filename, journal)
+  finally:
+    r.close()
+
+  os.remove(journal_filename)
+  return part_filename, h.hexdigest()
@@ -1,94 +1,334 @@
 import logging
-import requests
 import base64
+import asyncio
+import glob
+import os
+import time
+import weakref
 from lxml import etree
+import requests
 
-from .xml_tools import ADEPT_NS, NSMAP, add_subelement, get_error
+from .xml_tools import ADEPT_NS, NSMAP, add_subelement, get_error, is_auth_error, \
+  parse_xml, parse_xml_file, adept_path, select_text
 from . import utils
 from . import patch_epub
+from . import download
 from . import account
 from . import data
-from .api_call import FFAuth, InitLicense, Fulfillment
+from . import aio
+from .bom import FulfillmentRecord
+from .transport import get_transport
+from .api_call import FFAuth, InitLicense, Fulfillment, AuthError
+from .retry import Deadline, current_deadline
+
+# Operator authentications are reused for this long (seconds)
+DEFAULT_AUTH_TTL = 3600
+auth_ttl = DEFAULT_AUTH_TTL
+
+# Concurrent downloads for the same account and operator authenticate only once
+_auth_locks = weakref.WeakKeyDictionary()
+# and a book is only downloaded by one of them at a time
+_book_locks = weakref.WeakKeyDictionary()
+
+# Each step of a download is recorded in the fulfillment ledger, for the
+# account, resource and transaction of the ACSM
+# A book already downloaded is not fulfilled again while its file is
+# intact, and an interrupted download resumes after its last finished step
+skip_downloaded = True
+
+OPERATOR_URL = adept_path("operatorURL")
+RESOURCE = adept_path("resourceItemInfo/resource")
+TRANSACTION = adept_path("transaction")
 
 def parse_acsm(acsm_filename):
-  fftoken = etree.parse(acsm_filename)
+  fftoken = parse_xml_file(acsm_filename)
   token_root = fftoken.getroot()
 
-  operator = token_root.find("{http://ns.adobe.com/adept}operatorURL").text
+  operator = select_text(OPERATOR_URL, token_root)
 
   return operator, token_root
 
+def acsm_identifiers(token_root):
+  # (resource, transaction) of an ACSM, or None if it names no resource
+  resource = select_text(RESOURCE, token_root)
+  if resource is None:
+    return None
+  return resource, select_text(TRANSACTION, token_root) or ""
+
+def find_checkpoint(acc, identifiers):
+  # Record of the last step finished for this ACSM, if it can be resumed from
+  r = data.find_fulfillment(acc.urn, *identifiers)
+  if r is None or r.stage == FulfillmentRecord.FULFILLED:
+    return r
+  if download.is_intact(r.filename, r.size, r.sha256):
+    return r
+
+  logging.info("{} changed since it was downloaded, downloading it again".format(r.filename))
+  if r.stage == FulfillmentRecord.DOWNLOADED:
+    r.stage = FulfillmentRecord.FULFILLED
+    r.filename = r.size = r.sha256 = None
+    return r
+  return None
+
+def download_key(acc, identifiers, url):
+  # The .part file of a download is named after its ledger key
+  if identifiers is None:
+    return url
+  return "\n".join((acc.urn,) + identifiers)
+
+def new_record(acc, operator, identifiers, result):
+  r = FulfillmentRecord()
+  r.urn = acc.urn
+  if identifiers is not None:
+    r.resource, r.transaction = identifiers
+  r.operator = operator
+  r.title, r.src, license_token = result
+  if license_token is not None:
+    r.license_token = etree.tostring(license_token, encoding="unicode")
+  r.fulfilled_at = time.time()
+  return r
+
+def checkpoint(r, stage, filename=None, sha256=None):
+  # Records that a step is finished, and the file it produced
+  r.stage = stage
+  if filename is not None:
+    r.filename = os.path.abspath(filename)
+    r.size = os.path.getsize(filename)
+    r.sha256 = sha256 if sha256 is not None else download.file_sha256(filename)
+  # Without identifiers, there is nothing to resume from
+  if r.resource is not None:
+    data.record_fulfillment(r)
+
 def log_in(config, acc, operator):
+  return aio.run(log_in_async(config, acc, operator))
+
+async def log_in_async(config, acc, operator):
   ffauth = FFAuth(operator, acc, config)
-  result = ffauth.call()
+  init_license = InitLicense(operator, acc)
+
+  # InitLicense does not depend on the FFAuth reply: sign it in the meantime
+  signing = asyncio.ensure_future(init_license.prepare_async())
+  result = await ffauth.call_async()
+  await signing
 
   if result:
-    init_license = InitLicense(operator, acc)
-    result = init_license.call()
+    result = await init_license.call_async()
     return result
   else:
     logging.info(get_error(result))
     return False
 
-def generate_rights_xml(license_token):
-  adobe_certificate = "MIIEvjCCA6agAwIBAgIER2q5ljANBgkqhkiG9w0BAQUFADCBhDELMAkGA1UEBhMCVVMxIzAhBgNVBAoTGkFkb2JlIFN5c3RlbXMgSW5jb3Jwb3JhdGVkMRswGQYDVQQLExJEaWdpdGFsIFB1Ymxpc2hpbmcxMzAxBgNVBAMTKkFkb2JlIENvbnRlbnQgU2VydmVyIENlcnRpZmljYXRlIEF1dGhvcml0eTAeFw0wODA4MTExNjMzNDhaFw0xMzA4MTEwNzAwMDBaMIGIMQswCQYDVQQGEwJVUzEjMCEGA1UEChMaQWRvYmUgU3lzdGVtcyBJbmNvcnBvcmF0ZWQxGzAZBgNVBAsTEkRpZ2l0YWwgUHVibGlzaGluZzE3MDUGA1UEAxMuaHR0cHM6Ly9uYXNpZ25pbmdzZXJ2aWNlLmFkb2JlLmNvbS9saWNlbnNlc2lnbjCBnzANBgkqhkiG9w0BAQEFAAOBjQAwgYkCgYEAs9GRZ1f5UTRySgZ2xAL7TaDKQBfdpIS9ei9Orica0N72BB/WE+82G5lfsZ2HdeCFDZG/oz2WPLXovcuUAbFKSIXVLyc7ONOd4sczeXQYPixeAvqzGtsyMArIzaeJcriGVPRnbD/spbuHR0BHhJEakIiDtQLJz+xgVYHlicx2H/kCAwEAAaOCAbQwggGwMAsGA1UdDwQEAwIFoDBYBglghkgBhvprHgEESwxJVGhlIHByaXZhdGUga2V5IGNvcnJlc3BvbmRpbmcgdG8gdGhpcyBjZXJ0aWZpY2F0ZSBtYXkgaGF2ZSBiZWVuIGV4cG9ydGVkLjAUBgNVHSUEDTALBgkqhkiG9y8CAQIwgbIGA1UdIASBqjCBpzCBpAYJKoZIhvcvAQIDMIGWMIGTBggrBgEFBQcCAjCBhhqBg1lvdSBhcmUgbm90IHBlcm1pdHRlZCB0byB1c2UgdGhpcyBMaWNlbnNlIENlcnRpZmljYXRlIGV4Y2VwdCBhcyBwZXJtaXR0ZWQgYnkgdGhlIGxpY2Vuc2UgYWdyZWVtZW50IGFjY29tcGFueWluZyB0aGUgQWRvYmUgc29mdHdhcmUuMDEGA1UdHwQqMCgwJqAkoCKGIGh0dHA6Ly9jcmwuYWRvYmUuY29tL2Fkb2JlQ1MuY3JsMB8GA1UdIwQYMBaAFIvu8IFgyaLaHg5SwVgMBLBD94/oMB0GA1UdDgQWBBSQ5K+bvggI6Rbh2u9nPhH8bcYTITAJBgNVHRMEAjAAMA0GCSqGSIb3DQEBBQUAA4IBAQC0l1L+BRCccZdb2d9zQBJ7JHkXWt1x/dUydU9I/na+QPFE5x+fGK4cRwaIfp6fNviGyvtJ6Wnxe6du/wlarC1o26UNpyWpnAltcy47LpVXsmcV5rUlhBx10l4lecuX0nx8/xF8joRz2BvvAusK+kxgKeiAjJg2W20wbJKh0Otct1ZihruQsEtGbZJ1L55xfNhrm6CKAHuGuTDYQ/S6W20dUaDUiNFhA2n2eEySLwUwgOuuhfVUPb8amQQKbF4rOQ2rdjAskEl/0CiavW6Xv0LGihThf6CjEbNSdy+vXQ7K9wFbKsE843DflpuSPfj2Aagtyrv/j1HsBjsf03e0uVu5"
+async def ensure_logged_in(config, acc, operator):
+  locks = _auth_locks.setdefault(asyncio.get_running_loop(), {})
+  async with locks.setdefault((acc.urn, operator), asyncio.Lock()):
+    # The database may wait for another process: never on the event loop
+    if await aio.run_blocking(data.is_authenticated, acc.urn, operator, auth_ttl):
+      logging.debug("Reusing authentication to {}".format(operator))
+      return True
+
+    if not await log_in_async(config, acc, operator):
+      return False
 
-  #etree.ElementTree.register_namespace("adept", ADEPT_NS) 
+    await aio.run_blocking(data.set_authenticated, acc.urn, operator)
+    return True
+
+ADOBE_CERTIFICATE = "MIIEvjCCA6agAwIBAgIER2q5ljANBgkqhkiG9w0BAQUFADCBhDELMAkGA1UEBhMCVVMxIzAhBgNVBAoTGkFkb2JlIFN5c3RlbXMgSW5jb3Jwb3JhdGVkMRswGQYDVQQLExJEaWdpdGFsIFB1Ymxpc2hpbmcxMzAxBgNVBAMTKkFkb2JlIENvbnRlbnQgU2VydmVyIENlcnRpZmljYXRlIEF1dGhvcml0eTAeFw0wODA4MTExNjMzNDhaFw0xMzA4MTEwNzAwMDBaMIGIMQswCQYDVQQGEwJVUzEjMCEGA1UEChMaQWRvYmUgU3lzdGVtcyBJbmNvcnBvcmF0ZWQxGzAZBgNVBAsTEkRpZ2l0YWwgUHVibGlzaGluZzE3MDUGA1UEAxMuaHR0cHM6Ly9uYXNpZ25pbmdzZXJ2aWNlLmFkb2JlLmNvbS9saWNlbnNlc2lnbjCBnzANBgkqhkiG9w0BAQEFAAOBjQAwgYkCgYEAs9GRZ1f5UTRySgZ2xAL7TaDKQBfdpIS9ei9Orica0N72BB/WE+82G5lfsZ2HdeCFDZG/oz2WPLXovcuUAbFKSIXVLyc7ONOd4sczeXQYPixeAvqzGtsyMArIzaeJcriGVPRnbD/spbuHR0BHhJEakIiDtQLJz+xgVYHlicx2H/kCAwEAAaOCAbQwggGwMAsGA1UdDwQEAwIFoDBYBglghkgBhvprHgEESwxJVGhlIHByaXZhdGUga2V5IGNvcnJlc3BvbmRpbmcgdG8gdGhpcyBjZXJ0aWZpY2F0ZSBtYXkgaGF2ZSBiZWVuIGV4cG9ydGVkLjAUBgNVHSUEDTALBgkqhkiG9y8CAQIwgbIGA1UdIASBqjCBpzCBpAYJKoZIhvcvAQIDMIGWMIGTBggrBgEFBQcCAjCBhhqBg1lvdSBhcmUgbm90IHBlcm1pdHRlZCB0byB1c2UgdGhpcyBMaWNlbnNlIENlcnRpZmljYXRlIGV4Y2VwdCBhcyBwZXJtaXR0ZWQgYnkgdGhlIGxpY2Vuc2UgYWdyZWVtZW50IGFjY29tcGFueWluZyB0aGUgQWRvYmUgc29mdHdhcmUuMDEGA1UdHwQqMCgwJqAkoCKGIGh0dHA6Ly9jcmwuYWRvYmUuY29tL2Fkb2JlQ1MuY3JsMB8GA1UdIwQYMBaAFIvu8IFgyaLaHg5SwVgMBLBD94/oMB0GA1UdDgQWBBSQ5K+bvggI6Rbh2u9nPhH8bcYTITAJBgNVHRMEAjAAMA0GCSqGSIb3DQEBBQUAA4IBAQC0l1L+BRCccZdb2d9zQBJ7JHkXWt1x/dUydU9I/na+QPFE5x+fGK4cRwaIfp6fNviGyvtJ6Wnxe6du/wlarC1o26UNpyWpnAltcy47LpVXsmcV5rUlhBx10l4lecuX0nx8/xF8joRz2BvvAusK+kxgKeiAjJg2W20wbJKh0Otct1ZihruQsEtGbZJ1L55xfNhrm6CKAHuGuTDYQ/S6W20dUaDUiNFhA2n2eEySLwUwgOuuhfVUPb8amQQKbF4rOQ2rdjAskEl/0CiavW6Xv0LGihThf6CjEbNSdy+vXQ7K9wFbKsE843DflpuSPfj2Aagtyrv/j1HsBjsf03e0uVu5"
+
+RIGHTS_END = b"</rights>"
+
+def build_license_service_info():
+  # Serialized once: it is the same in every rights.xml
   rights = etree.Element("{%s}rights" % ADEPT_NS, nsmap=NSMAP)
-  rights.append(license_token)
   lsi = etree.Element("{%s}licenseServiceInfo" % ADEPT_NS, nsmap=NSMAP)
   add_subelement(lsi, "licenseURL", "https://nasigningservice.adobe.com/licensesign")
-  add_subelement(lsi, "certificate", adobe_certificate)
+  add_subelement(lsi, "certificate", ADOBE_CERTIFICATE)
   rights.append(lsi)
-  
-  return etree.tostring(rights, doctype='<?xml version="1.0"?>')
+
+  xml = etree.tostring(rights)
+  return xml[xml.index(b"<licenseServiceInfo"):-len(RIGHTS_END)]
+
+LICENSE_SERVICE_INFO = build_license_service_info()
+
+def generate_rights_xml(license_token):
+  rights = etree.Element("{%s}rights" % ADEPT_NS, nsmap=NSMAP)
+  rights.append(license_token)
+
+  xml = etree.tostring(rights, doctype='<?xml version="1.0"?>')
+  return xml[:-len(RIGHTS_END)] + LICENSE_SERVICE_INFO + RIGHTS_END
 
 def fulfill(acsm_content, a, operator):
+  return aio.run(fulfill_async(acsm_content, a, operator))
+
+async def fulfill_async(acsm_content, a, operator, ff=None):
+  # ff: a Fulfillment request already prepared for this ACSM, if any
   logging.info("Sending fullfilment request")
-  ff = Fulfillment(acsm_content, a, operator)
-  return ff.call()
+  if ff is None:
+    ff = Fulfillment(acsm_content, a, operator)
+  result = await ff.call_async()
+  if is_auth_error(ff.error):
+    raise AuthError(ff.error)
+  return result
 
-def get_ebook(filename):
-  logging.info("Opening {} ...".format(filename))
+async def log_in_and_fulfill(config, acc, operator, acsm_content):
+  # The fulfillment request is signed while we authenticate
+  ff = Fulfillment(acsm_content, acc, operator)
+  signing = asyncio.ensure_future(ff.prepare_async())
+  logged_in = await ensure_logged_in(config, acc, operator)
+  await signing
 
-  a = data.get_current_account()
-  if a is None:
-    logging.error("Please log in with a user and select it first")
-    return
+  if not logged_in:
+    logging.info("Failed to init license")
+    return None
 
   try:
-    # The ACSM file contains a "fulfillment URL" that we must query
-    # in order to get the real file URL
-    operator, acsm_content = parse_acsm(filename)
-
-    if not log_in(data.config, a, operator):
+    return await fulfill_async(acsm_content, acc, operator, ff)
+  except AuthError:
+    # Our cached authentication is not valid anymore: authenticate again, once
+    logging.info("Authentication to {} expired, logging in again".format(operator))
+    await aio.run_blocking(data.invalidate_authentication, acc.urn, operator)
+    if not await ensure_logged_in(config, acc, operator):
       logging.info("Failed to init license")
-      return
+      return None
+    return await fulfill_async(acsm_content, acc, operator)
+
+def preconnect(url):
+  # Fire and forget: the connection is left in the transport pool
+  aio.get_executor().submit(get_transport().preconnect, url)
 
-    title, ebook_url, license_token = fulfill(acsm_content, a, operator)
+async def fetch_book(a, operator, acsm_content, identifiers):
+  # Runs the steps of the download left for this ACSM
+  record = None
+  if skip_downloaded and identifiers is not None:
+    record = await aio.run_blocking(find_checkpoint, a, identifiers)
+
+  if record is None:
+    # Open connections while the first requests are being signed
+    preconnect(operator)
+    if not await aio.run_blocking(data.is_authenticated, a.urn, operator, auth_ttl):
+      preconnect(InitLicense.URL)
+
+    result = await log_in_and_fulfill(data.config, a, operator, acsm_content)
+    if result is None:
+      return None
+
+    title, ebook_url, license_token = result
 
     if ebook_url is None:
       raise Exception("Fulfillment error")
 
+    record = new_record(a, operator, identifiers, result)
+    await aio.run_blocking(checkpoint, record, FulfillmentRecord.FULFILLED)
+    resumed = False
+  elif record.stage == FulfillmentRecord.DONE:
+    logging.info("Already downloaded to {}".format(record.filename))
+    return record.filename
+  else:
+    logging.info("Resuming after the {} step".format(record.stage))
+    title, ebook_url = record.title, record.src
+    license_token = parse_xml(record.license_token)
+    resumed = True
+
+  # TODO: configurable output ?
+  epub_filename = "{0}.epub".format(title)
+
+  if record.stage == FulfillmentRecord.DOWNLOADED:
+    tmp_filename = record.filename
+    rights_xml = await aio.run_blocking(generate_rights_xml, license_token)
+  else:
     # Get epub URL and download it
+    # A file containing the license token must be added to the epub: it is
+    # generated during the download
     logging.info("Downloading {} from {} ...".format(title, ebook_url))
-    r = requests.get(ebook_url)
-    r.raise_for_status()
-    epub = r.content
-
-    # A file containing the license token must be added to the epub
-    logging.info("Patching epub ...")
-    rights_xml = generate_rights_xml(license_token)    
-    patched_epub = patch_epub.patch(epub, rights_xml)
-
-    # Write file to disc
-    # TODO: configurable output ?
-    epub_filename = "{0}.epub".format(title)
-    logging.info("Writing {} ...".format(epub_filename))
-    with open(epub_filename, "wb") as epub_file:
-      epub_file.write(patched_epub)
-
-    logging.info("Successfully downloaded file {}".format(epub_filename))
+    try:
+      (tmp_filename, sha256), rights_xml = await asyncio.gather(
+        aio.run_blocking(download.download_to_file, ebook_url, epub_filename,
+                         download_key(a, identifiers, ebook_url)),
+        aio.run_blocking(generate_rights_xml, license_token))
+    except requests.exceptions.HTTPError as e:
+      if resumed and e.response is not None and 400 <= e.response.status_code < 500:
+        # The book URL of an earlier fulfillment may have expired: start over next time
+        await aio.run_blocking(data.discard_fulfillment, a.urn, *identifiers)
+      raise
+    logging.debug("Downloaded file SHA-256: {}".format(sha256))
+    await aio.run_blocking(checkpoint, record, FulfillmentRecord.DOWNLOADED, tmp_filename, sha256)
+
+  # The downloaded file is kept if this fails: it is checked before it is used again
+  logging.info("Patching epub ...")
+  await aio.run_blocking(patch_epub.patch_file, tmp_filename, rights_xml)
+
+  logging.info("Writing {} ...".format(epub_filename))
+  os.replace(tmp_filename, epub_filename)
+  await aio.run_blocking(checkpoint, record, FulfillmentRecord.DONE, epub_filename)
+
+  logging.info("Successfully downloaded file {}".format(epub_filename))
+  return epub_filename
+
+def get_ebook(filename, deadline=None):
+  return aio.run(get_ebook_async(filename, deadline))
+
+async def get_ebook_async(filename, deadline=None):
+  # deadline: maximum duration in seconds for the whole download, if any
+  logging.info("Opening {} ...".format(filename))
+
+  if deadline is not None:
+    # Only visible from this task and the executor jobs it starts
+    current_deadline.set(Deadline(deadline))
+
+  a = await aio.run_blocking(data.get_current_account)
+  if a is None:
+    logging.error("Please log in with a user and select it first")
+    return None
+
+  try:
+    # The ACSM file contains a "fulfillment URL" that we must query
+    # in order to get the real file URL
+    operator, acsm_content = await aio.run_blocking(parse_acsm, filename)
+
+    identifiers = acsm_identifiers(acsm_content)
+    # The same ACSM may be given twice: the second copy waits for the
+    # first one, then finds its record in the ledger
+    key = (a.urn,) + identifiers if identifiers is not None else (a.urn, os.path.realpath(filename))
+    locks = _book_locks.setdefault(asyncio.get_running_loop(), {})
+    async with locks.setdefault(key, asyncio.Lock()):
+      return await fetch_book(a, operator, acsm_content, identifiers)
   except:
     logging.exception("Error when downloading book !")
+    return None
+
+def find_acsm_files(sources):
+  # Sources may be files, directories (all ACSM files inside) or glob patterns
+  # A file found through several sources is only listed once
+  filenames = []
+  for source in sources:
+    if os.path.isdir(source):
+      filenames.extend(sorted(glob.glob(os.path.join(source, "*.acsm"))))
+    elif os.path.exists(source):
+      filenames.append(source)
+    else:
+      matches = sorted(glob.glob(source))
+      if len(matches) == 0:
+        # Keep it so that it is reported as a failure
+        filenames.append(source)
+      filenames.extend(matches)
+
+  seen = set()
+  unique = []
+  for filename in filenames:
+    path = os.path.realpath(filename)
+    if path not in seen:
+      seen.add(path)
+      unique.append(filename)
+  return unique
+
+def get_ebooks(filenames, workers=4, deadline=None):
+  return aio.run(get_ebooks_async(filenames, workers, deadline))
+
+async def get_ebooks_async(filenames, workers=4, deadline=None):
+  # Returns a list of (acsm filename, epub filename or None if it failed)
+  semaphore = asyncio.Semaphore(workers)
+
+  async def worker(filename):
+    async with semaphore:
+      return filename, await get_ebook_async(filename, deadline)
 
+  return await asyncio.gather(*[worker(f) for f in filenames])
@@ -0,0 +1,50 @@
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 256
+DEFAULT_TTL = 3600
+
+class KeyCache:
+  # Decoded key material, keyed by (account urn, kind, inputs...)
+  # Least recently used entries are evicted first
+  def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+    self.max_entries = max_entries
+    self.ttl = ttl
+    self.entries = OrderedDict()
+    self.lock = threading.Lock()
+    # Caches of values made from our keys (e.g. parsed private keys), which
+    # are not keyed by account: they are cleared whenever we are invalidated
+    self.derived = []
+
+  def get(self, key, loader):
+    now = time.monotonic()
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None and now - entry[0] < self.ttl:
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    # Loaded outside the lock: two threads may both load the same key, which is harmless
+    value = loader()
+
+    with self.lock:
+      self.entries[key] = (now, value)
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+    return value
+
+  def invalidate(self, urn=None):
+    with self.lock:
+      if urn is None:
+        self.entries.clear()
+      else:
+        for key in [k for k in self.entries if k[0] == urn]:
+          del self.entries[key]
+
+    for cache in self.derived:
+      cache.invalidate()
+
+key_cache = KeyCache()
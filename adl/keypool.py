@@ -0,0 +1,65 @@
+import collections
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait
+
+from . import utils
+
+# RSA key generation is CPU bound: a pool of processes generates the key
+# pairs ahead of time, so that signing in does not wait for them
+class KeyPool:
+  def __init__(self, size, workers=None, refill=True):
+    # refill: whether a key taken from the pool is replaced by a new one
+    self.size = size
+    self.refill = refill
+    self.workers = workers if workers is not None else (os.cpu_count() or 1)
+    self.pending = collections.deque()
+    self.lock = threading.Lock()
+    self.executor = None
+
+    try:
+      # Default start method of the platform: forking a process which runs
+      # threads (e.g. the executor of aio) may deadlock the child
+      self.executor = ProcessPoolExecutor(max_workers=self.workers)
+    except (OSError, NotImplementedError, ValueError):
+      logging.warning("Cannot start key generation processes, generating keys in process")
+
+    self.fill()
+
+  def fill(self):
+    if self.executor is None:
+      return
+    with self.lock:
+      while len(self.pending) < self.size:
+        self.pending.append(self.executor.submit(utils.generate_key_pair))
+
+  def wait(self):
+    # Blocks until the keys already requested are generated
+    with self.lock:
+      pending = list(self.pending)
+    wait(pending)
+
+  def get(self):
+    with self.lock:
+      future = self.pending.popleft() if len(self.pending) > 0 else None
+
+    if future is None:
+      return utils.generate_key_pair()
+
+    if self.refill:
+      self.fill()
+    try:
+      return future.result()
+    except Exception:
+      logging.warning("Key generation process failed, generating key in process", exc_info=True)
+      return utils.generate_key_pair()
+
+  def close(self):
+    if self.executor is not None:
+      with self.lock:
+        for future in self.pending:
+          future.cancel()
+        self.pending.clear()
+      self.executor.shutdown(wait=True)
+      self.executor = None
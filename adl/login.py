@@ -1,5 +1,8 @@
 import logging
 import base64
+import asyncio
+import contextlib
+import time
 
 from cryptography.hazmat.primitives.asymmetric import padding as asym_padding
 from cryptography import x509
@@ -7,33 +10,129 @@ from cryptography import x509
 from .bom import Account, Device, Config
 from . import utils
 from . import device
+from . import aio
 from .api_call import ActivationInit, AuthenticationInit, SignInDirect
+from .keypool import KeyPool
 from . import data
 
-def login(user, password):
-  acc = Account()
+@contextlib.contextmanager
+def timing(step):
+  # Duration of each step, shown in verbose mode
+  start = time.monotonic()
+  try:
+    yield
+  finally:
+    logging.debug("{} took {:.0f} ms".format(step, (time.monotonic() - start) * 1000))
+
+async def timed(step, coro):
+  with timing(step):
+    return await coro
 
+def login(user, password):
+  return aio.run(login_async(user, password))
+
+async def login_async(user, password):
+  with timing("Login"):
+    # The two key pairs are generated by other processes while we fetch the service info
+    key_pool = KeyPool(2, 2, refill=False)
+    try:
+      await asyncio.gather(init_config_async(),
+                           timed("Key generation", aio.run_blocking(key_pool.wait)))
+      acc = await aio.run_blocking(provision, user, password, key_pool)
+    finally:
+      key_pool.close()
+
+    if acc is None:
+      logging.error('Sign in error')
+      return
+
+    # Store
+    d = acc.get_device('local')
+    with data.transaction():
+      data.add_account(acc)
+      data.add_device(acc.urn, d)
+      data.set_current_account(acc.urn)
+
+def init_config():
+  aio.run(init_config_async())
+
+async def init_config_async():
   config = data.config
   if config is None:
     config = Config()
 
   if not config.ready():
-    config.auth_url, config.userinfo_url, config.activation_certificate = activation_init()
-    config.authentication_certificate = authentication_init()
+    # Both service info requests are independent
+    activation_info, authentication_certificate = await asyncio.gather(
+      timed("Activation service info", ActivationInit().call_async()),
+      timed("Authentication service info", AuthenticationInit().call_async()))
+    config.auth_url, config.userinfo_url, config.activation_certificate = activation_info
+    config.authentication_certificate = authentication_certificate
     data.store_config(config)
 
-  if not sign_in(data, acc, user, password):
-    logging.error('Sign in error')
-    return
+def provision(user, password, key_pool=None):
+  # Signs in and activates this computer, without storing the account
+  acc = Account()
+  with timing("Sign in"):
+    if not sign_in(data, acc, user, password, key_pool):
+      return None
 
   # Activate this computer
   d = acc.get_device('local')
-  device.activate(acc, d)
-
-  # Store
-  data.add_account(acc)
-  data.add_device(acc.urn, d)
-  data.set_current_account(acc.urn)
+  with timing("Activation"):
+    device.activate(acc, d)
+  return acc
+
+########### Batch ############
+
+def read_credentials(filename):
+  # One account per line: "<adobeID> <password>", or "anonymous"
+  # Empty lines and lines starting with # are ignored
+  credentials = []
+  with open(filename, "r") as f:
+    for line in f:
+      line = line.strip()
+      if line == "" or line.startswith("#"):
+        continue
+      if line == "anonymous":
+        credentials.append((None, None))
+        continue
+      user, _, password = line.partition(" ")
+      credentials.append((user, password.strip()))
+  return credentials
+
+def login_batch(credentials, workers=4, key_workers=None):
+  # Returns a list of (user, account or None if it failed)
+  # Each sign in takes two key pairs: they are generated while we fetch the service info
+  key_pool = KeyPool(2 * workers, key_workers)
+  try:
+    init_config()
+    results = aio.run(provision_all(credentials, workers, key_pool))
+  finally:
+    key_pool.close()
+
+  accounts = [acc for _, acc in results if acc is not None]
+  if len(accounts) > 0:
+    with data.transaction():
+      data.add_accounts(accounts)
+      if data.get_current_account() is None:
+        data.set_current_account(accounts[0].urn)
+
+  return results
+
+async def provision_all(credentials, workers, key_pool):
+  semaphore = asyncio.Semaphore(workers)
+
+  async def worker(user, password):
+    async with semaphore:
+      try:
+        acc = await aio.run_blocking(provision, user, password, key_pool)
+      except Exception:
+        logging.exception("Error when signing in {}".format(user))
+        acc = None
+      return user, acc
+
+  return await asyncio.gather(*[worker(u, p) for u, p in credentials])
 
 ########### Activation Info ############
 
@@ -75,7 +174,7 @@ def generate_auth_data(user, password, binary_device_key):
 
   return serialized_auth_data
 
-def sign_in(data, acc, user, password):
+def sign_in(data, acc, user, password, key_pool=None):
   d = Device()
   d.generate_key()
   d.generate_fingerprint()
@@ -96,10 +195,10 @@ def sign_in(data, acc, user, password):
   certificate = x509.load_der_x509_certificate(base64.b64decode(data.config.authentication_certificate))
 
   # generate auth key pair
-  acc.auth_key = utils.generate_key_pair()
+  acc.auth_key = key_pool.get() if key_pool is not None else utils.generate_key_pair()
 
   # generate license key pair
-  acc.license_key = utils.generate_key_pair()
+  acc.license_key = key_pool.get() if key_pool is not None else utils.generate_key_pair()
 
   # Encrypt with public auth service certificate
   public_auth_key = certificate.public_key()
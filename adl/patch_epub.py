@@ -14,27 +14,222 @@
 
 import zipfile
 import io
+import os
+import shutil
+import struct
+import sys
+import time
+import zlib
 import argparse
 
+RIGHTS_FILENAME = "META-INF/rights.xml"
+
+# Zip records, see PKWARE's APPNOTE.TXT
+LOCAL_HEADER = struct.Struct("<4sHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<4sBBHHHHHIIIHHHHHII")
+END_RECORD = struct.Struct("<4sHHHHIIH")
+ZIP64_END_RECORD = struct.Struct("<4sQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<4sIQI")
+# Zip64 extra field holding only a local header offset
+ZIP64_OFFSET_EXTRA = struct.Struct("<HHQ")
+
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+CENTRAL_HEADER_SIGNATURE = b"PK\x01\x02"
+END_RECORD_SIGNATURE = b"PK\x05\x06"
+ZIP64_END_RECORD_SIGNATURE = b"PK\x06\x06"
+ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+
+# Same limits as zipfile: above them, the Zip64 records are used
+ZIP64_LIMIT = (1 << 31) - 1
+ZIP_FILECOUNT_LIMIT = (1 << 16) - 1
+
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+CREATE_SYSTEM = 0 if sys.platform == "win32" else 3
+MAX_COMMENT = 0xFFFF
+
+class ArchiveTail:
+  # The central directory and end records, which follow the entries
+  # Offsets are relative to the start of the archive, which is base in the
+  # file (e.g. after the stub of a self-extracting archive)
+  def __init__(self, base, cd_offset, cd_size, comment):
+    self.base = base
+    self.cd_offset = cd_offset
+    self.cd_size = cd_size
+    self.comment = comment
+
+def read_tail(f):
+  f.seek(0, os.SEEK_END)
+  size = f.tell()
+  start = max(0, size - END_RECORD.size - MAX_COMMENT)
+  f.seek(start)
+  data = f.read()
+
+  # The end record is the last one whose comment runs to the end of the file
+  pos = data.rfind(END_RECORD_SIGNATURE)
+  while pos >= 0:
+    if pos + END_RECORD.size <= len(data):
+      fields = END_RECORD.unpack_from(data, pos)
+      if pos + END_RECORD.size + fields[7] == len(data):
+        break
+    pos = data.rfind(END_RECORD_SIGNATURE, 0, pos)
+  if pos < 0:
+    raise zipfile.BadZipFile("End of central directory not found")
+
+  _, disk, cd_disk, _, _, cd_size, cd_offset, _ = fields
+  comment = data[pos + END_RECORD.size:]
+  records_offset = start + pos
+
+  # The Zip64 end record is right before its locator
+  locator_pos = pos - ZIP64_LOCATOR.size
+  if locator_pos >= 0 and data[locator_pos:locator_pos + 4] == ZIP64_LOCATOR_SIGNATURE:
+    records_offset = start + locator_pos - ZIP64_END_RECORD.size
+    f.seek(records_offset)
+    record = f.read(ZIP64_END_RECORD.size)
+    if records_offset < 0 or record[:4] != ZIP64_END_RECORD_SIGNATURE:
+      raise zipfile.BadZipFile("Zip64 end of central directory not found")
+    _, _, _, _, disk, cd_disk, _, _, cd_size, cd_offset = ZIP64_END_RECORD.unpack(record)
+
+  if disk != 0 or cd_disk != 0:
+    raise zipfile.BadZipFile("Archives spanning several disks are not supported")
+  base = records_offset - cd_offset - cd_size
+  if base < 0:
+    raise zipfile.BadZipFile("Bad central directory offset")
+  return ArchiveTail(base, cd_offset, cd_size, comment)
+
+def header_offset(fields, extra):
+  # Local header offset of a central directory entry, from its Zip64 extra
+  # field if needed
+  offset = fields[17]
+  if offset != 0xFFFFFFFF:
+    return offset
+  pos = 0
+  while pos + 4 <= len(extra):
+    tag, size = struct.unpack_from("<HH", extra, pos)
+    if tag == 1:
+      # Sizes come first, when they do not fit in the header either
+      index = (fields[10] == 0xFFFFFFFF) + (fields[9] == 0xFFFFFFFF)
+      return struct.unpack_from("<Q", extra, pos + 4 + 8 * index)[0]
+    pos += 4 + size
+  raise zipfile.BadZipFile("Missing Zip64 extra field")
+
+def iter_central_directory(cd):
+  # Yields the name, local header offset and raw header of each entry
+  pos = 0
+  while pos < len(cd):
+    if cd[pos:pos + 4] != CENTRAL_HEADER_SIGNATURE:
+      raise zipfile.BadZipFile("Bad central directory")
+    fields = CENTRAL_HEADER.unpack_from(cd, pos)
+    name_start = pos + CENTRAL_HEADER.size
+    extra_start = name_start + fields[11]
+    end = extra_start + fields[12] + fields[13]
+    yield cd[name_start:extra_start], header_offset(fields, cd[extra_start:extra_start + fields[12]]), cd[pos:end]
+    pos = end
+
+def dos_date_time(t):
+  t = time.localtime(t)
+  return (t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday, t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+
+def write_entry(f, base, offset, name, content):
+  # Writes a stored entry at offset, returns its central directory header
+  name = name.encode("utf-8")
+  flags = 0 if name.isascii() else 0x800
+  date, dos_time = dos_date_time(time.time())
+  crc = zlib.crc32(content)
+
+  version = ZIP_VERSION
+  extra = b""
+  offset_field = offset
+  if offset > ZIP64_LIMIT:
+    version = ZIP64_VERSION
+    extra = ZIP64_OFFSET_EXTRA.pack(1, 8, offset)
+    offset_field = 0xFFFFFFFF
+
+  f.seek(base + offset)
+  f.write(LOCAL_HEADER.pack(LOCAL_HEADER_SIGNATURE, version, flags, zipfile.ZIP_STORED, dos_time, date,
+                            crc, len(content), len(content), len(name), 0))
+  f.write(name)
+  f.write(content)
+
+  return CENTRAL_HEADER.pack(CENTRAL_HEADER_SIGNATURE, version, CREATE_SYSTEM, version, flags, zipfile.ZIP_STORED, dos_time, date,
+                             crc, len(content), len(content), len(name), len(extra), 0, 0, 0, 0o600 << 16, offset_field) + name + extra
+
+def write_end(f, entries, cd_offset, cd_size, comment):
+  # Writes the end records right after the central directory
+  if entries > ZIP_FILECOUNT_LIMIT or cd_offset > ZIP64_LIMIT or cd_size > ZIP64_LIMIT:
+    zip64_offset = cd_offset + cd_size
+    f.write(ZIP64_END_RECORD.pack(ZIP64_END_RECORD_SIGNATURE, ZIP64_END_RECORD.size - 12, ZIP64_VERSION, ZIP64_VERSION,
+                                  0, 0, entries, entries, cd_size, cd_offset))
+    f.write(ZIP64_LOCATOR.pack(ZIP64_LOCATOR_SIGNATURE, 0, zip64_offset, 1))
+    entries = min(entries, 0xFFFF)
+    cd_offset = min(cd_offset, 0xFFFFFFFF)
+    cd_size = min(cd_size, 0xFFFFFFFF)
+  f.write(END_RECORD.pack(END_RECORD_SIGNATURE, 0, 0, entries, entries, cd_size, cd_offset, len(comment)))
+  f.write(comment)
+
+def set_entry(f, name, content):
+  # Adds an entry to the archive in the seekable file f, replacing the
+  # entries of the same name
+  # Only the end of the archive is read and written: the new entry goes over
+  # the central directory (or over the replaced entry, if it is the last one),
+  # followed by the central directory and end records
+  # A replaced entry which is not the last one stays in the file, but is not
+  # part of the archive anymore
+  tail = read_tail(f)
+  f.seek(tail.base + tail.cd_offset)
+  central_directory = f.read(tail.cd_size)
+  if len(central_directory) != tail.cd_size:
+    raise zipfile.BadZipFile("Truncated central directory")
+
+  encoded_name = name.encode("utf-8")
+  headers = []
+  last_kept = -1
+  replaced = []
+  for entry_name, offset, header in iter_central_directory(central_directory):
+    if entry_name == encoded_name:
+      replaced.append(offset)
+    else:
+      headers.append(header)
+      last_kept = max(last_kept, offset)
+
+  offset = tail.cd_offset
+  if replaced and max(replaced) > last_kept:
+    offset = max(replaced)
+
+  headers.append(write_entry(f, tail.base, offset, name, content))
+  cd_offset = f.tell() - tail.base
+  cd_size = 0
+  for header in headers:
+    f.write(header)
+    cd_size += len(header)
+  write_end(f, len(headers), cd_offset, cd_size, tail.comment)
+  f.truncate()
+
 def patch(raw_data, rights_content):
+  if isinstance(rights_content, str):
+    rights_content = rights_content.encode("utf-8")
   buf = io.BytesIO(raw_data)
-  z = zipfile.ZipFile(buf, mode='a')
-  z.writestr("META-INF/rights.xml", rights_content)
-  z.close()
+  set_entry(buf, RIGHTS_FILENAME, rights_content)
   new_data = buf.getvalue()
   buf.close()
   return new_data
 
+def patch_file(filename, rights_content):
+  # Patches the archive on disk, in place
+  # An existing rights.xml (e.g. a book fulfilled again) is replaced
+  if isinstance(rights_content, str):
+    rights_content = rights_content.encode("utf-8")
+  with open(filename, "r+b") as f:
+    set_entry(f, RIGHTS_FILENAME, rights_content)
+
 if __name__ == "__main__":
   parser = argparse.ArgumentParser(description='Patch the epub file to add the rights.xml file')
   parser.add_argument('--filename', dest="filename", required=True,
                       help='The epub')
+  parser.add_argument('--output', dest="output", default="patched.epub",
+                      help='The patched epub')
 
   args = parser.parse_args()
 
-  with open(args.filename) as f:
-    data = f.read()
-    buf = patch(data, "<toto/>")
-    
-    with open("patched.epub", "w") as w:
-      w.write(buf)
+  shutil.copyfile(args.filename, args.output)
+  patch_file(args.output, "<toto/>")
@@ -0,0 +1,76 @@
+import contextvars
+import random
+import time
+
+class DeadlineExceeded(Exception):
+  pass
+
+class Deadline:
+  def __init__(self, seconds):
+    self.expires = time.monotonic() + seconds
+
+  def remaining(self):
+    return self.expires - time.monotonic()
+
+  def check(self):
+    if self.remaining() <= 0:
+      raise DeadlineExceeded()
+
+# Deadline of the operation being run (e.g. a whole get_ebook), if any
+current_deadline = contextvars.ContextVar("current_deadline", default=None)
+
+def remaining_time():
+  deadline = current_deadline.get()
+  if deadline is None:
+    return None
+  deadline.check()
+  return deadline.remaining()
+
+def limit_timeout(timeout):
+  # (connect, read) timeouts which do not go beyond the current deadline
+  remaining = remaining_time()
+  if remaining is None:
+    return timeout
+  connect_timeout, read_timeout = timeout
+  return (min(connect_timeout, remaining), min(read_timeout, remaining))
+
+def check_deadline():
+  deadline = current_deadline.get()
+  if deadline is not None:
+    deadline.check()
+
+class RetryPolicy:
+  def __init__(self, attempts=4, base_delay=0.5, max_delay=20.0):
+    self.attempts = attempts
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+
+  def can_retry(self, attempt):
+    return attempt + 1 < self.attempts
+
+  def backoff(self, attempt):
+    # Exponential backoff with full jitter
+    return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+  def wait(self, attempt):
+    delay = self.backoff(attempt)
+    remaining = remaining_time()
+    if remaining is not None and remaining <= delay:
+      raise DeadlineExceeded()
+    time.sleep(delay)
+    return delay
+
+def is_transient_exception(exc, idempotent):
+  # A request which may have reached the server is only retried if it is idempotent
+  # requests is only imported by the commands using the network
+  import requests
+  if isinstance(exc, requests.exceptions.ConnectTimeout):
+    return True
+  if isinstance(exc, requests.exceptions.HTTPError) and exc.response is not None:
+    status = exc.response.status_code
+    if status in (429, 503):
+      return True
+    return idempotent and status >= 500
+  if isinstance(exc, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+    return idempotent
+  return False
@@ -0,0 +1,141 @@
+import logging
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+from .retry import DeadlineExceeded, remaining_time
+
+# Requests in flight to a single host
+DEFAULT_HOST_CONCURRENCY = 8
+# Consecutive failures after which a host is not contacted for a while
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_COOLDOWN = 30
+
+class CircuitOpenError(requests.exceptions.RequestException):
+  pass
+
+class TokenBucket:
+  def __init__(self, rate, burst):
+    self.rate = rate
+    self.capacity = burst
+    self.tokens = burst
+    self.updated = time.monotonic()
+    self.lock = threading.Lock()
+
+  def acquire(self):
+    while True:
+      with self.lock:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+          self.tokens -= 1
+          return
+        wait = (1 - self.tokens) / self.rate
+      # Never wait beyond the deadline of the current operation
+      remaining = remaining_time()
+      if remaining is not None and remaining <= wait:
+        raise DeadlineExceeded()
+      time.sleep(wait)
+
+class CircuitBreaker:
+  CLOSED = "closed"
+  OPEN = "open"
+  HALF_OPEN = "half-open"
+
+  def __init__(self, name, threshold, cooldown):
+    self.name = name
+    self.threshold = threshold
+    self.cooldown = cooldown
+    self.state = self.CLOSED
+    self.failures = 0
+    self.opened_at = 0
+    self.probing = False
+    self.lock = threading.Lock()
+
+  def before_request(self):
+    with self.lock:
+      if self.state == self.OPEN:
+        if time.monotonic() - self.opened_at < self.cooldown:
+          raise CircuitOpenError("{} is unavailable, not sending request".format(self.name))
+        self.state = self.HALF_OPEN
+
+      if self.state == self.HALF_OPEN:
+        # Only one request probes the host, the others fail fast
+        if self.probing:
+          raise CircuitOpenError("{} is unavailable, not sending request".format(self.name))
+        self.probing = True
+
+  def record_success(self):
+    with self.lock:
+      if self.state != self.CLOSED:
+        logging.info("{} is available again".format(self.name))
+      self.state = self.CLOSED
+      self.failures = 0
+      self.probing = False
+
+  def record_failure(self):
+    with self.lock:
+      self.failures += 1
+      self.probing = False
+      if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+        if self.state != self.OPEN:
+          logging.warning("{} failed {} times, pausing requests for {}s".format(self.name, self.failures, self.cooldown))
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+
+class HostLimiter:
+  def __init__(self, name, max_concurrency, rate, burst, threshold, cooldown):
+    self.semaphore = threading.BoundedSemaphore(max_concurrency)
+    self.bucket = None
+    if rate is not None:
+      self.bucket = TokenBucket(rate, burst if burst is not None else max(1, rate))
+    self.breaker = CircuitBreaker(name, threshold, cooldown)
+
+class Throttle:
+  # Limits shared by all the requests sent to a host (concurrency, rate, circuit breaker)
+  def __init__(self, max_concurrency=DEFAULT_HOST_CONCURRENCY, rate=None, burst=None,
+               failure_threshold=DEFAULT_FAILURE_THRESHOLD, cooldown=DEFAULT_COOLDOWN):
+    self.max_concurrency = max_concurrency
+    self.rate = rate
+    self.burst = burst
+    self.failure_threshold = failure_threshold
+    self.cooldown = cooldown
+    self.hosts = {}
+    self.lock = threading.Lock()
+
+  def get_host(self, url):
+    host = urlsplit(url).netloc
+    with self.lock:
+      if host not in self.hosts:
+        self.hosts[host] = HostLimiter(host, self.max_concurrency, self.rate, self.burst,
+                                       self.failure_threshold, self.cooldown)
+      return self.hosts[host]
+
+  def request(self, url, send):
+    limiter = self.get_host(url)
+
+    # The slot and the token are taken before asking the breaker: waiting for
+    # them may hit the deadline, which must not leave a probe in flight forever
+    if not limiter.semaphore.acquire(timeout=remaining_time()):
+      raise DeadlineExceeded()
+    try:
+      if limiter.bucket is not None:
+        limiter.bucket.acquire()
+
+      limiter.breaker.before_request()
+      try:
+        r = send()
+      except Exception:
+        limiter.breaker.record_failure()
+        raise
+    finally:
+      limiter.semaphore.release()
+
+    if r.status_code >= 500 or r.status_code == 429:
+      limiter.breaker.record_failure()
+    else:
+      limiter.breaker.record_success()
+    return r
@@ -0,0 +1,70 @@
+import logging
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+from .throttle import Throttle, CircuitBreaker
+
+# Number of per-host pools kept alive, and connections kept in each of them
+DEFAULT_POOL_CONNECTIONS = 10
+DEFAULT_POOL_MAXSIZE = 10
+# (connect, read) timeouts in seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+class Transport:
+  def __init__(self, pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, timeout=DEFAULT_TIMEOUT, throttle=None):
+    self.pool_connections = pool_connections
+    self.pool_maxsize = pool_maxsize
+    self.timeout = timeout
+    self.throttle = throttle if throttle is not None else Throttle()
+
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+
+  def post(self, url, **kwargs):
+    kwargs.setdefault("timeout", self.timeout)
+    return self.throttle.request(url, lambda: self.session.post(url, **kwargs))
+
+  def get(self, url, **kwargs):
+    kwargs.setdefault("timeout", self.timeout)
+    return self.throttle.request(url, lambda: self.session.get(url, **kwargs))
+
+  def head(self, url, **kwargs):
+    kwargs.setdefault("timeout", self.timeout)
+    return self.throttle.request(url, lambda: self.session.head(url, **kwargs))
+
+  def preconnect(self, url):
+    # Opens a connection to the host of url and leaves it in the pool, so that
+    # the next request to this host does not wait for TCP and TLS handshakes
+    # A HEAD request: it goes through the same pool and host limits as the
+    # real requests
+    if self.throttle.get_host(url).breaker.state != CircuitBreaker.CLOSED:
+      # The host is failing: a probe is left to a real request
+      return
+    try:
+      self.head(url)
+    except Exception:
+      logging.debug("Could not pre-connect to {}".format(url), exc_info=True)
+
+  def close(self):
+    self.session.close()
+
+_default = None
+_lock = threading.Lock()
+
+def configure(pool_connections=DEFAULT_POOL_CONNECTIONS, pool_maxsize=DEFAULT_POOL_MAXSIZE, timeout=DEFAULT_TIMEOUT, throttle=None):
+  global _default
+  with _lock:
+    if _default is not None:
+      _default.close()
+    _default = Transport(pool_connections, pool_maxsize, timeout, throttle)
+  return _default
+
+def get_transport():
+  global _default
+  with _lock:
+    if _default is None:
+      _default = Transport()
+    return _default
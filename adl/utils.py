@@ -11,6 +11,8 @@ from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend as crypto_default_backend
 from cryptography.hazmat.primitives import serialization as crypto_serialization
 
+from .keycache import key_cache
+
 nbnonce = 0
 
 def make_nonce():
@@ -24,21 +26,27 @@ def make_nonce():
 def get_expiration_date():
   return datetime.datetime.strftime(datetime.datetime.now(datetime.timezone.utc)+datetime.timedelta(minutes=30), "%Y-%m-%dT%H:%M:%S-00:00")
 
-def extract_pk_from_pkcs12(acc, device_key):
-  pk, _, _ = pkcs12.load_key_and_certificates(base64.b64decode(acc.pkcs12), device_key)
+def load_pkcs12(acc, device_key):
+  # Returns the private key and the certificate, both DER encoded
+  def load():
+    pk, cert, _ = pkcs12.load_key_and_certificates(base64.b64decode(acc.pkcs12), device_key)
 
-  pk_der = pk.private_bytes(
-      crypto_serialization.Encoding.DER,
-      crypto_serialization.PrivateFormat.TraditionalOpenSSL,
-      crypto_serialization.NoEncryption())
+    pk_der = pk.private_bytes(
+        crypto_serialization.Encoding.DER,
+        crypto_serialization.PrivateFormat.TraditionalOpenSSL,
+        crypto_serialization.NoEncryption())
+    cert_der = cert.public_bytes(crypto_serialization.Encoding.DER)
 
-  return pk_der
+    return pk_der, cert_der
 
-def extract_cert_from_pkcs12(acc, device_key):
-  _ , cert, _ = pkcs12.load_key_and_certificates(base64.b64decode(acc.pkcs12), device_key)
+  return key_cache.get((acc.urn, "pkcs12", acc.pkcs12, device_key), load)
 
-  cert_der = cert.public_bytes(crypto_serialization.Encoding.DER)
+def extract_pk_from_pkcs12(acc, device_key):
+  pk_der, _ = load_pkcs12(acc, device_key)
+  return pk_der
 
+def extract_cert_from_pkcs12(acc, device_key):
+  _, cert_der = load_pkcs12(acc, device_key)
   return cert_der
 
 def aes_crypt(msg, key):
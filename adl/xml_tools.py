@@ -14,11 +14,11 @@
 
 from lxml import etree
 import struct
-import re
 import hashlib
 import base64
+import threading
 
-from .crypto import RSAHandler
+from .crypto import get_signer
 
 from cryptography.hazmat.primitives.asymmetric import padding, utils
 from cryptography.hazmat.primitives import hashes
@@ -31,77 +31,122 @@ ATTRIBUTE=5
 
 ADEPT_NS="http://ns.adobe.com/adept"
 NSMAP = {None: ADEPT_NS}
+DC_NS="http://purl.org/dc/elements/1.1/"
 
-def add_byte(o, i):
-  o = o + struct.pack('B', i);
-  return o
+# ADEPT errors that go away when the request is rebuilt with a fresh nonce
+# and expiration, see APICall.transient_errors
+TRANSIENT_ERRORS = ["E_ADEPT_REQUEST_EXPIRED"]
 
-def add_str(o, s):
+_pack_byte = struct.Struct('B').pack
+_pack_len = struct.Struct('>H').pack
+
+BEGIN_ELEMENT_BYTE = _pack_byte(BEGIN_ELEMENT)
+END_ATTRIBUTES_BYTE = _pack_byte(END_ATTRIBUTES)
+END_ELEMENT_BYTE = _pack_byte(END_ELEMENT)
+TEXT_NODE_BYTE = _pack_byte(TEXT_NODE)
+ATTRIBUTE_BYTE = _pack_byte(ATTRIBUTE)
+
+# Elements left out of the signed data
+SKIPPED_ELEMENTS = ["hmac", "signature"]
+
+def pack_str(s):
   es = s.encode("utf-8")
-  o = o + struct.pack('>H', len(es))
-  o = o + es
-  return o
+  return _pack_len(len(es)) + es
 
 def parse_namespace(tag, default_ns):
-  m = re.match("{(.*)}(.*)", tag)
-  if m is not None:
-    return m.group(2), m.group(1)
+  if tag.startswith("{"):
+    ns, _, name = tag[1:].rpartition("}")
+    return name, ns
   else:
     return tag, default_ns
 
+# tag -> serialized BEGIN_ELEMENT header, or None for skipped elements
+_element_headers = {}
+
+def element_header(tag):
+  header = _element_headers.get(tag, False)
+  if header is False:
+    name, ns = parse_namespace(tag, ADEPT_NS)
+    if name in SKIPPED_ELEMENTS:
+      header = None
+    else:
+      header = BEGIN_ELEMENT_BYTE + pack_str(ns) + pack_str(name)
+    _element_headers[tag] = header
+  return header
+
+def serialize_to(root, write):
+  # Writes the ADEPT canonical form of root, in document order
+  # The tree is walked iteratively, so that deep documents cannot hit the recursion limit
+  def begin(node):
+    header = element_header(node.tag)
+    if header is None:
+      return False
+    write(header)
+    attrib = node.attrib
+    for attr_name in sorted(attrib.keys()):
+      write(ATTRIBUTE_BYTE)
+      write(b"\x00\x00")
+      write(pack_str(attr_name))
+      write(pack_str(str(attrib[attr_name])))
+    write(END_ATTRIBUTES_BYTE)
+    return True
+
+  def end(node):
+    # In ActionScript, the text field is a child
+    # Here it should work because the XML has either children or text
+    text = node.text
+    if text is not None:
+      text = text.strip()
+      if text != "":
+        write(TEXT_NODE_BYTE)
+        write(pack_str(text))
+    write(END_ELEMENT_BYTE)
+
+  if not begin(root):
+    return
+
+  stack = [(root, iter(root))]
+  while stack:
+    node, children = stack[-1]
+    for child in children:
+      if begin(child):
+        stack.append((child, iter(child)))
+        break
+    else:
+      end(node)
+      stack.pop()
+
 def serialize(node):
-  out = bytes()
-  name, ns = parse_namespace(node.tag, ADEPT_NS)
-  if name in ["hmac", "signature"]:
-    return b""
-  out = add_byte(out, BEGIN_ELEMENT)
-  out = add_str(out, ns)
-  out = add_str(out, name)
-  for attr_name in sorted(node.attrib.keys()):
-    out = add_byte(out, ATTRIBUTE)
-    out = add_str(out, "")
-    out = add_str(out, attr_name)
-    out = add_str(out, str(node.attrib[attr_name]))
-  out = add_byte(out, END_ATTRIBUTES)
-  for child in node:
-    out = out + serialize(child)
-  # In ActionScript, the text field is a child
-  # Here it should work because the XML has either children or text
-  if node.text is not None and node.text.strip() != "":
-    out = add_byte(out, TEXT_NODE)
-    out = add_str(out, node.text.strip())
-  out = add_byte(out, END_ELEMENT)
-  return out
+  out = bytearray()
+  serialize_to(node, out.extend)
+  return bytes(out)
 
-def xml_hash(s):
+def hash_element(node):
+  # The canonical form is fed to SHA-1 as it is produced, without building it
   h = hashlib.sha1()
-  h.update(s)
-  d = h.hexdigest()
-  # Force big endian
-  return b"".join(struct.pack('>I', int(d[i*8:i*8+8], 16)) for i in range(5))
+  serialize_to(node, h.update)
+  return h.digest()
+
+def xml_hash(s):
+  return hashlib.sha1(s).digest()
 
 # key as byte array
 def encrypt(hxml, key):
-  rsa = RSAHandler(key)
-  sig = rsa.encrypt(hxml)
-
-  return sig
-
-def generate_signature(xml_str, key):
-  xml = etree.fromstring(xml_str)
-  # First normalize and serialize the XML
-  sxml = serialize(xml)
-  # Compute the sha1
-  hxml = xml_hash(sxml)
+  return get_signer(key).sign(hxml)
+
+def generate_signature(xml, key):
+  # xml may be an element or its serialized form
+  if not etree.iselement(xml):
+    xml = etree.fromstring(xml)
+  # Compute the sha1 of the normalized XML
+  hxml = hash_element(xml)
   # Encrypt it with private key
   sig = encrypt(hxml, key)
   return base64.b64encode(sig)
 
 def sign_xml(element, pk):
-  xml_str = etree.tostring(element)
-
   signature = etree.Element("signature")
-  signature.text = generate_signature(xml_str, pk)
+  signature.text = generate_signature(element, pk)
   element.append(signature)
 
   return element
@@ -112,9 +157,68 @@ def add_subelement(element, name, text):
   element.append(e)
   return e
 
-def get_error(xml):
-  tree_root = etree.fromstring(xml)
+# lxml parsers must not be used by several threads at once
+_parsers = threading.local()
+
+def get_parser():
+  parser = getattr(_parsers, "parser", None)
+  if parser is None:
+    # Replies come from the network: no entities, DTD or network access
+    parser = etree.XMLParser(resolve_entities=False, load_dtd=False, no_network=True, huge_tree=False)
+    _parsers.parser = parser
+  return parser
+
+def parse_xml(xml):
+  if isinstance(xml, str):
+    # Lets the XML declaration name its encoding
+    xml = xml.encode("utf-8")
+  return etree.fromstring(xml, get_parser())
+
+def parse_xml_file(filename):
+  return etree.parse(filename, get_parser())
+
+def adept_path(path):
+  # "a/b" -> compiled selector for the ADEPT elements a/b under the context node
+  # "dc:" selects elements of the Dublin Core namespace instead
+  steps = []
+  for step in path.split("/"):
+    if step.startswith("dc:"):
+      steps.append("{%s}%s" % (DC_NS, step[3:]))
+    else:
+      steps.append("{%s}%s" % (ADEPT_NS, step))
+  return etree.ETXPath("/".join(steps), smart_strings=False)
+
+def select(selector, root):
+  # First match, or None
+  result = selector(root)
+  return result[0] if result else None
+
+def select_text(selector, root):
+  element = select(selector, root)
+  return element.text if element is not None else None
+
+def get_root_error(tree_root):
   if 'error' in tree_root.tag:
     return tree_root.get('data')
   return None
 
+def get_error(xml):
+  return get_root_error(parse_xml(xml))
+
+def is_auth_error(error):
+  # Errors look like "E_ADEPT_... <url>"
+  return error is not None and "AUTH" in error.split(" ")[0]
+
+def get_error_code(reply):
+  # reply: the text of a reply or its root element
+  if reply is None:
+    return None
+  if not etree.iselement(reply):
+    try:
+      reply = parse_xml(reply)
+    except (etree.XMLSyntaxError, ValueError):
+      return None
+  error = get_root_error(reply)
+  if error is None:
+    return None
+  return error.split(" ")[0]
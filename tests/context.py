@@ -3,4 +3,4 @@ import sys
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 import adl
-from adl import login, account, xml_tools, utils, device, db, api_call, epub_get, patch_epub, bom, data
+from adl import login, account, xml_tools, utils, device, db, api_call, epub_get, patch_epub, bom, data, transport, download, retry, throttle, keycache, crypto, keypool
@@ -0,0 +1,230 @@
+from context import db, bom, account
+
+import unittest
+import tempfile
+import threading
+import os
+from unittest.mock import patch
+
+class TestDB(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.store = db.DBData()
+    self.store.db.db_path = self.tmp.name
+    self.store.config = bom.Config()
+    self.store.db.store_config(self.store.config)
+
+  def tearDown(self):
+    self.store.db.close()
+    self.tmp.cleanup()
+
+  def make_account(self, urn):
+    d = bom.Device()
+    d.name = "local"
+    d.device_key = b"S0VZ"
+    d.device_id = "urn:device:" + urn
+    a = bom.Account()
+    a.urn = urn
+    return a, d
+
+  def test_schema(self):
+    connector = self.store.db.connector
+    self.assertEqual(connector.execute("PRAGMA user_version").fetchone()[0], db.DB.SCHEMA_VERSION)
+    self.assertEqual(connector.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+
+    # The connection is kept open
+    self.store.set_authenticated("urn:a", "http://fairyland.com")
+    self.assertIs(self.store.db.connector, connector)
+
+  def test_transaction(self):
+    a, d = self.make_account("urn:a")
+    with self.store.transaction():
+      self.store.add_account(a)
+      self.store.add_device(a.urn, d)
+      self.store.set_current_account(a.urn)
+
+    b, d = self.make_account("urn:b")
+    # The device cannot be stored: the account is not stored either
+    d.device_key = None
+    with self.store.transaction():
+      self.store.add_account(b)
+      self.store.add_device(b.urn, d)
+
+    accounts = self.store.db.load_accounts()
+    self.assertEqual([x.urn for x in accounts], ["urn:a"])
+    self.assertEqual(accounts[0].devices[0].device_id, "urn:device:urn:a")
+    self.assertEqual(self.store.db.load_config().current_user, "urn:a")
+
+  def test_registry(self):
+    a, d = self.make_account("urn:a")
+    a.sign_id = "toto@adobe.com"
+    d.fingerprint = "FP1"
+    e = bom.Device()
+    e.name = "reader"
+    e.device_key = b"S0VZ"
+    e.device_id = "urn:device:reader"
+    e.fingerprint = "FP2"
+    a.devices = [d, e]
+    b, _ = self.make_account("urn:b")
+    self.store.add_accounts([a, b])
+
+    # Devices are loaded with their account, accounts without device are kept
+    accounts = self.store.db.load_accounts()
+    self.assertEqual([x.urn for x in accounts], ["urn:a", "urn:b"])
+    self.assertEqual([x.device_id for x in accounts[0].devices], ["urn:device:urn:a", "urn:device:reader"])
+    self.assertEqual(accounts[1].devices, [])
+
+    indexes = [row[0] for row in self.store.db.connector.execute("select name from sqlite_master where type='index'")]
+    for name in db.DB.DB_INDEXES:
+      self.assertIn(name, indexes)
+
+    self.store.accounts = accounts
+    self.assertIs(self.store.find_account_by_urn("urn:b"), accounts[1])
+    self.assertIs(self.store.find_account_by_sign("toto@adobe.com"), accounts[0])
+    self.assertEqual(self.store.find_device_by_fingerprint("urn:a", "FP2").name, "reader")
+    self.assertIsNone(self.store.find_device_by_fingerprint("urn:b", "FP2"))
+
+    self.store.delete_account(accounts[1])
+    self.assertIsNone(self.store.find_account_by_urn("urn:b"))
+
+    self.assertRaises(AttributeError, setattr, a, "unknown", 1)
+
+  def open_other(self):
+    # Another process using the same database
+    other = db.DBData()
+    other.db.db_path = self.tmp.name
+    other.load()
+    self.addCleanup(other.db.close)
+    return other
+
+  def test_other_process_changes(self):
+    a, d = self.make_account("urn:a")
+    self.store.add_account(a)
+    self.store.load()
+    accounts = self.store.accounts
+
+    other = self.open_other()
+    other.set_authenticated("urn:a", "http://fairyland.com")
+    self.assertTrue(self.store.is_authenticated("urn:a", "http://fairyland.com", 60))
+    # Only the changed table is reloaded
+    self.assertIs(self.store.accounts, accounts)
+
+    b, d = self.make_account("urn:b")
+    other.add_account(b)
+    # Reads bring our data up to date
+    self.store.get_current_account()
+    self.assertIsNotNone(self.store.find_account_by_urn("urn:b"))
+
+    # Our own view is up to date before a write
+    self.store.add_device("urn:b", d)
+    self.assertEqual(len(other.db.load_accounts()[1].devices), 1)
+
+  def test_busy(self):
+    other = self.open_other()
+    other.db.BUSY_TIMEOUT = 0
+    other.db.close()
+
+    # Another process holds the write lock for a while
+    self.store.db.connect()
+    self.store.db.begin(immediate=True)
+    threading.Timer(0.3, self.store.db.connector.commit).start()
+
+    a, d = self.make_account("urn:a")
+    with patch.object(db.DB, "busy_retry_policy", db.RetryPolicy(attempts=10, base_delay=0.1, max_delay=0.2)):
+      other.add_account(a)
+    self.assertEqual([x.urn for x in self.store.db.load_accounts()], ["urn:a"])
+
+  def test_export_import(self):
+    a, d = self.make_account("urn:a")
+    a.sign_id = "toto@adobe.com"
+    b, e = self.make_account("urn:b")
+    # Not activated yet
+    e.device_id = None
+    a.devices = [d]
+    b.devices = [e]
+    self.store.add_accounts([a, b])
+    self.store.set_current_account("urn:a")
+
+    with tempfile.TemporaryDirectory() as tmp:
+      bundle = os.path.join(tmp, "accounts.ndjson.gz")
+      with patch.object(account, "data", self.store):
+        self.assertEqual(account.account_export(bundle), 2)
+      self.assertEqual(os.stat(bundle).st_mode & 0o777, 0o600)
+
+      target = db.DBData()
+      target.db.db_path = tmp
+      target.load()
+      self.addCleanup(target.db.close)
+      with patch.object(account, "data", target):
+        self.assertEqual(account.account_import(bundle), 2)
+        # Importing again updates the accounts
+        self.store.db.cursor().execute("update users set sign_id='titi@adobe.com' where user_id='urn:a'")
+        with patch.object(account, "data", self.store):
+          account.account_export(bundle)
+        self.assertEqual(account.account_import(bundle), 2)
+
+      accounts = target.db.load_accounts()
+      self.assertEqual([x.urn for x in accounts], ["urn:a", "urn:b"])
+      self.assertEqual(accounts[0].sign_id, "titi@adobe.com")
+      self.assertEqual([x.device_id for x in accounts[0].devices], ["urn:device:urn:a"])
+      self.assertEqual(accounts[1].devices[0].device_key, b"S0VZ")
+      # Devices without device_id are not duplicated either
+      self.assertEqual(len(accounts[1].devices), 1)
+      self.assertIsNone(target.config.current_user)
+      self.assertEqual(target.find_account_by_urn("urn:b").urn, "urn:b")
+
+  def test_data_dir(self):
+    with patch.dict(os.environ, {db.DATA_DIR_ENV: self.tmp.name, db.TENANT_ENV: "acme"}):
+      store = db.DBData()
+    self.assertEqual(store.db_path, os.path.join(self.tmp.name, "tenants", "acme"))
+    self.assertEqual(store.db.db_path, store.db_path)
+    # Nothing is read until it is needed
+    self.assertIsNone(store.db.connector)
+    self.assertIsNone(store.config)
+    self.assertIsNotNone(store.db.connector)
+    store.close()
+    self.assertRaises(ValueError, db.DBData, self.tmp.name, tenant="../acme")
+
+  def test_shards(self):
+    a, d = self.make_account("urn:a")
+    self.store.add_account(a)
+    # Accounts already stored in the main database are not sharded
+    store = db.DBData(self.tmp.name, shards=4)
+    store.load()
+    self.addCleanup(store.close)
+    self.assertEqual(store.shard_count, 0)
+
+    with tempfile.TemporaryDirectory() as tmp:
+      store = db.DBData(tmp, shards=4)
+      store.load()
+      self.addCleanup(store.close)
+      store.store_config(bom.Config())
+      accounts = []
+      for i in range(8):
+        a, d = self.make_account("urn:{}".format(i))
+        a.devices = [d]
+        accounts.append(a)
+      store.add_accounts(accounts)
+      store.set_current_account("urn:0")
+      store.set_authenticated("urn:0", "http://fairyland.com")
+      self.assertGreater(len(os.listdir(os.path.join(tmp, "shards"))), 1)
+      self.assertFalse(store.db.has_accounts())
+
+      # The number of shards is read from the data directory
+      other = db.DBData(tmp)
+      other.load()
+      self.addCleanup(other.close)
+      self.assertEqual(other.shard_count, 4)
+      # Only the shard of the current account is opened
+      self.assertEqual(other.get_current_account().devices[0].device_id, "urn:device:urn:0")
+      self.assertTrue(other.is_authenticated("urn:0", "http://fairyland.com", 60))
+      self.assertEqual(other.loaded_shards, {other.shard_of("urn:0")})
+      self.assertEqual(sorted(x.urn for x in other.accounts), sorted(x.urn for x in accounts))
+
+      store.delete_account(store.find_account_by_urn("urn:1"))
+      other.refresh()
+      self.assertIsNone(other.find_account_by_urn("urn:1"))
+      self.assertEqual(len([r for r in other.export_records() if r["type"] == "account"]), 7)
+
+if __name__ == '__main__':
+  unittest.main()
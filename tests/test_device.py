@@ -12,7 +12,6 @@ class TestDevice(unittest.TestCase):
     default_account.urn = "toto"
     default_account.sign_id = "toto@adobe.com"
     default_account.sign_method = "AdobeID"
-    default_account.get_private_key = MagicMock(return_value="SuperSecretKey")
 
     activationToken = "<activationToken></activationToken>"
 
@@ -22,7 +21,8 @@ class TestDevice(unittest.TestCase):
     conf.activation_certificate = 'ACT_CERTIFICATE'
     conf.authentication_certificate = 'AUTH_CERTIFICATE'
 
-    content = device.build_activation_file(default_account, activationToken, conf)
+    with patch.object(bom.Account, "get_private_key", return_value="SuperSecretKey"):
+      content = device.build_activation_file(default_account, activationToken, conf)
 
     self.assertEqual(content, expected)    
 
@@ -71,11 +71,11 @@ class TestDevice(unittest.TestCase):
     d = bom.Device()
 
     # Mock methods
-    backup = device.activate, data.add_device, default_account.get_private_key, device.read_device_file, device.read_activation_file, device.build_activation_file, device.write_activation_file
+    backup = device.activate, data.add_device, bom.Account.get_private_key, device.read_device_file, device.read_activation_file, device.build_activation_file, device.write_activation_file
 
     device.activate = MagicMock(return_value="<activationToken></activationToken>")
 
-    default_account.get_private_key = MagicMock(return_value="SuperSecretKey")
+    bom.Account.get_private_key = MagicMock(return_value="SuperSecretKey")
     data.add_device = MagicMock()
 
     device.read_device_file = MagicMock(return_value=d)
@@ -95,7 +95,7 @@ class TestDevice(unittest.TestCase):
     device.activate.assert_called()
 
     # restore methods
-    device.activate, data.add_device, default_account.get_private_key, device.read_device_file, device.read_activation_file, device.build_activation_file, device.write_activation_file = backup
+    device.activate, data.add_device, bom.Account.get_private_key, device.read_device_file, device.read_activation_file, device.build_activation_file, device.write_activation_file = backup
 
   def test_activate(self):
     a = bom.Account()
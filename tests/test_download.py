@@ -0,0 +1,130 @@
+from context import download, retry
+import unittest
+import hashlib
+import os
+import tempfile
+import threading
+from unittest.mock import patch, MagicMock
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+CONTENT = os.urandom(3 * 1024 * 1024 + 17)
+
+class RangeHandler(BaseHTTPRequestHandler):
+  support_range = True
+  # Bytes sent before the requested range
+  range_shift = 0
+  requests = []
+
+  def do_GET(self):
+    RangeHandler.requests.append(dict(self.headers))
+    start = 0
+    rng = self.headers.get("Range")
+    if self.support_range and rng is not None and self.headers.get("If-Range") in (None, '"v1"'):
+      start = int(rng[len("bytes="):-1]) - self.range_shift
+      self.send_response(206)
+      self.send_header("Content-Range", "bytes {}-{}/{}".format(start, len(CONTENT) - 1, len(CONTENT)))
+    else:
+      self.send_response(200)
+    self.send_header("ETag", '"v1"')
+    self.send_header("Content-Length", str(len(CONTENT) - start))
+    self.end_headers()
+    self.wfile.write(CONTENT[start:])
+
+  def log_message(self, *args):
+    pass
+
+class TestDownload(unittest.TestCase):
+  def setUp(self):
+    RangeHandler.requests = []
+    RangeHandler.support_range = True
+    RangeHandler.range_shift = 0
+    self.server = HTTPServer(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=self.server.serve_forever, daemon=True).start()
+    self.url = "http://127.0.0.1:{}/book.epub".format(self.server.server_port)
+    self.tmpdir = tempfile.TemporaryDirectory()
+    self.destination = os.path.join(self.tmpdir.name, "book.epub")
+
+  def tearDown(self):
+    self.server.shutdown()
+    self.server.server_close()
+    self.tmpdir.cleanup()
+
+  def make_partial(self, size, etag='"v1"'):
+    part_filename, journal_filename = download.part_filenames(self.destination, self.url)
+    with open(part_filename, "wb") as f:
+      f.write(CONTENT[:size])
+    download.write_journal(journal_filename, {"url": self.url, "etag": etag, "last_modified": None, "written": size})
+
+  def check_result(self, result):
+    part_filename, sha256 = result
+    with open(part_filename, "rb") as f:
+      self.assertEqual(f.read(), CONTENT)
+    self.assertEqual(sha256, hashlib.sha256(CONTENT).hexdigest())
+    self.assertFalse(os.path.exists(download.part_filenames(self.destination, self.url)[1]))
+
+  def test_full(self):
+    self.check_result(download.download_to_file(self.url, self.destination))
+    self.assertNotIn("Range", RangeHandler.requests[0])
+
+  def test_resume(self):
+    self.make_partial(1024 * 1024 + 5)
+    self.check_result(download.download_to_file(self.url, self.destination))
+    self.assertEqual(RangeHandler.requests[0]["Range"], "bytes=1048581-")
+    self.assertEqual(RangeHandler.requests[0]["If-Range"], '"v1"')
+
+  def test_no_range_support(self):
+    RangeHandler.support_range = False
+    self.make_partial(1000)
+    self.check_result(download.download_to_file(self.url, self.destination))
+
+  def test_changed_file(self):
+    self.make_partial(1000, etag='"v0"')
+    self.check_result(download.download_to_file(self.url, self.destination))
+
+  def test_no_validator(self):
+    # Nothing tells whether the remote file changed: it is downloaded again
+    self.make_partial(1000, etag=None)
+    self.check_result(download.download_to_file(self.url, self.destination))
+    self.assertNotIn("Range", RangeHandler.requests[0])
+
+  def test_wrong_range(self):
+    self.make_partial(1000)
+    RangeHandler.range_shift = 10
+    self.check_result(download.download_to_file(self.url, self.destination))
+    self.assertEqual(len(RangeHandler.requests), 2)
+    self.assertNotIn("Range", RangeHandler.requests[1])
+
+  def test_deadline(self):
+    t = MagicMock()
+    t.timeout = (10, 60)
+    t.get.return_value.status_code = 200
+    t.get.return_value.headers = {}
+    t.get.return_value.iter_content.return_value = [CONTENT]
+    token = retry.current_deadline.set(retry.Deadline(5))
+    self.addCleanup(retry.current_deadline.reset, token)
+    with patch.object(download, "get_transport", return_value=t):
+      download.download_to_file(self.url, self.destination)
+    # A stalled read does not go beyond the deadline
+    connect_timeout, read_timeout = t.get.call_args[1]["timeout"]
+    self.assertLessEqual(connect_timeout, 5)
+    self.assertLessEqual(read_timeout, 5)
+
+  @unittest.skipIf(download.fcntl is None, "Downloads are not locked")
+  def test_locked(self):
+    # Another worker is downloading the same book
+    self.make_partial(1000)
+    part_filename, journal_filename = download.part_filenames(self.destination, self.url)
+    with open(part_filename, "r+b") as f:
+      download.fcntl.flock(f.fileno(), download.fcntl.LOCK_EX)
+      self.assertRaises(download.DownloadInProgress, download.download_to_file, self.url, self.destination)
+    self.assertEqual(RangeHandler.requests, [])
+    self.assertEqual(os.path.getsize(part_filename), 1000)
+
+    # Same title, another book: another file
+    other = download.download_to_file(self.url, self.destination, "urn:uuid:other")
+    self.assertNotEqual(other[0], part_filename)
+    with open(other[0], "rb") as f:
+      self.assertEqual(f.read(), CONTENT)
+
+if __name__ == '__main__':
+  unittest.main()
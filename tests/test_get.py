@@ -1,7 +1,13 @@
-from context import epub_get, account, db, utils, device, xml_tools, patch_epub, data, bom
-from unittest.mock import patch, MagicMock, call, mock_open
+from context import epub_get, account, db, utils, device, xml_tools, patch_epub, data, bom, api_call, transport
+from unittest.mock import patch, MagicMock, AsyncMock, call
 
 import unittest
+import asyncio
+import io
+import os
+import tempfile
+import time
+import zipfile
 from lxml import etree
 
 class TestGet(unittest.TestCase):
@@ -17,6 +23,24 @@ class TestGet(unittest.TestCase):
     operator, _ = epub_get.parse_acsm("files/fake.acsm")
     self.assertEqual(operator, "https://acs4.kobo.com/fulfillment")
 
+  def test_parse_fulfillment(self):
+    reply = '<envelope xmlns="http://ns.adobe.com/adept"><fulfillmentResult><resourceItemInfo><src>http://fairyland.com/book.epub</src><licenseToken><resource>urn:1</resource></licenseToken><metadata><dc:title xmlns:dc="http://purl.org/dc/elements/1.1/">Calamity</dc:title></metadata></resourceItemInfo></fulfillmentResult></envelope>'
+    ff = api_call.Fulfillment(None, None, None)
+    title, url, license_token = ff.parse(reply)
+    self.assertEqual((title, url), ("Calamity", "http://fairyland.com/book.epub"))
+    self.assertEqual(license_token.tag, "{http://ns.adobe.com/adept}licenseToken")
+    self.assertIsNone(ff.error)
+
+    ff = api_call.Fulfillment(None, None, None)
+    reply = '<error xmlns="http://ns.adobe.com/adept" data="E_ADEPT_DOCUMENT_ERROR http://fairyland.com/Fulfill"/>'
+    self.assertEqual(ff.parse(reply), (None, None, None))
+    self.assertEqual(ff.error, "E_ADEPT_DOCUMENT_ERROR http://fairyland.com/Fulfill")
+
+    # Entities are not expanded
+    reply = '<!DOCTYPE e [<!ENTITY x SYSTEM "file:///etc/passwd">]><error xmlns="http://ns.adobe.com/adept" data="&x;"/>'
+    ff = api_call.Fulfillment(None, None, None)
+    self.assertRaises(etree.XMLSyntaxError, ff.parse, reply)
+
   def test_login(self):
     d = bom.Device()
     d.device_key = 1
@@ -41,14 +65,14 @@ class TestGet(unittest.TestCase):
     utils.get_expiration_date = MagicMock(return_value="2021-04-15T23:27:34-00:00")
     xml_tools.generate_signature = MagicMock(return_value="0123456789ABCDEF")
 
-    with patch('requests.post') as mock_request:
+    with patch('requests.Session.post') as mock_request:
       mock_request.return_value.status_code = 200
       mock_request.return_value.text = "success"
 
       epub_get.log_in(c, a, "http://fairyland.com")
 
-      auth_call = call('http://fairyland.com/Auth', data=b'<credentials xmlns="http://ns.adobe.com/adept"><user>toto</user><certificate>REVBREJFRUY=</certificate><licenseCertificate>LICENSECERT</licenseCertificate><authenticationCertificate>AUTHCERT</authenticationCertificate></credentials>', headers={'Content-type': 'application/vnd.adobe.adept+xml', 'charset': 'utf-8'})
-      initlicense_call = call('http://adeactivate.adobe.com/adept/InitLicenseService', data=b'<licenseServiceRequest xmlns="http://ns.adobe.com/adept" identity="user"><operatorURL>http://fairyland.com</operatorURL><nonce>11Mo2AAAAAA=</nonce><expiration>2021-04-15T23:27:34-00:00</expiration><user>toto</user><signature>0123456789ABCDEF</signature></licenseServiceRequest>', headers={'Content-type': 'application/vnd.adobe.adept+xml', 'charset': 'utf-8'})
+      auth_call = call('http://fairyland.com/Auth', data=b'<credentials xmlns="http://ns.adobe.com/adept"><user>toto</user><certificate>REVBREJFRUY=</certificate><licenseCertificate>LICENSECERT</licenseCertificate><authenticationCertificate>AUTHCERT</authenticationCertificate></credentials>', headers={'Content-type': 'application/vnd.adobe.adept+xml', 'charset': 'utf-8'}, timeout=transport.DEFAULT_TIMEOUT)
+      initlicense_call = call('http://adeactivate.adobe.com/adept/InitLicenseService', data=b'<licenseServiceRequest xmlns="http://ns.adobe.com/adept" identity="user"><operatorURL>http://fairyland.com</operatorURL><nonce>11Mo2AAAAAA=</nonce><expiration>2021-04-15T23:27:34-00:00</expiration><user>toto</user><signature>0123456789ABCDEF</signature></licenseServiceRequest>', headers={'Content-type': 'application/vnd.adobe.adept+xml', 'charset': 'utf-8'}, timeout=transport.DEFAULT_TIMEOUT)
       rfs = call().raise_for_status()
       mock_request.assert_has_calls([auth_call, rfs, initlicense_call, rfs])
 
@@ -58,7 +82,7 @@ class TestGet(unittest.TestCase):
   def test_fulfillment(self):
     d = bom.Device()
     d.device_id = "urn:1"
-    d.device_type = "mobile"
+    d.type = "mobile"
     d.device_key = 1
     d.name = "local"
 
@@ -73,7 +97,7 @@ class TestGet(unittest.TestCase):
     utils.extract_pk_from_pkcs12 = MagicMock(return_value="DEADBEEF")
     xml_tools.generate_signature = MagicMock(return_value="0123456789ABCDEF")
     
-    with patch('requests.post') as mock_request:
+    with patch('requests.Session.post') as mock_request:
       mock_request.return_value.status_code = 200
       mock_request.return_value.text = '<fulfillment><fulfillmentResult xmlns="http://ns.adobe.com/adept"><resourceItemInfo xmlns="http://ns.adobe.com/adept"><licenseToken>toto</licenseToken><src>http://books.com/mybook.epub</src><metadata><title xmlns="http://purl.org/dc/elements/1.1/">My great book</title></metadata></resourceItemInfo></fulfillmentResult></fulfillment>'
 
@@ -85,6 +109,40 @@ class TestGet(unittest.TestCase):
 
     utils.extract_pk_from_pkcs12, xml_tools.generate_signature = backup
 
+  def test_fulfillment_concurrent(self):
+    d = bom.Device()
+    d.device_id = "urn:1"
+    d.device_key = 1
+    d.name = "local"
+
+    a = bom.Account()
+    a.urn = "toto"
+    a.devices = [d]
+
+    operator = "http://fairyland.com"
+
+    backup = utils.extract_pk_from_pkcs12, xml_tools.generate_signature
+    utils.extract_pk_from_pkcs12 = MagicMock(return_value="DEADBEEF")
+    xml_tools.generate_signature = MagicMock(return_value="0123456789ABCDEF")
+
+    async def fulfill_all():
+      contents = [etree.Element("Content") for i in range(20)]
+      return await asyncio.gather(*[epub_get.fulfill_async(c, a, operator) for c in contents])
+
+    with patch('requests.Session.post') as mock_request:
+      mock_request.return_value.status_code = 200
+      mock_request.return_value.text = '<fulfillmentResult xmlns="http://ns.adobe.com/adept"><fulfillmentResult><resourceItemInfo><licenseToken>toto</licenseToken><src>http://books.com/mybook.epub</src><metadata><title xmlns="http://purl.org/dc/elements/1.1/">My great book</title></metadata></resourceItemInfo></fulfillmentResult></fulfillmentResult>'
+
+      results = asyncio.run(fulfill_all())
+
+      self.assertEqual(len(results), 20)
+      self.assertEqual(mock_request.call_count, 20)
+      for title, url, _ in results:
+        self.assertEqual(title, "My great book")
+        self.assertEqual(url, "http://books.com/mybook.epub")
+
+    utils.extract_pk_from_pkcs12, xml_tools.generate_signature = backup
+
   def test_get(self):
     d = bom.Device()
     d.name = "local"
@@ -99,33 +157,218 @@ class TestGet(unittest.TestCase):
     data.config = c
     data.accounts = [a]
 
-    filename = 'files/fake.acsm'
+    filename = os.path.abspath('files/fake.acsm')
 
     license_token = etree.Element("licenseToken")
     license_token.text = "toto"
 
-    backup = epub_get.log_in, epub_get.fulfill, epub_get.generate_rights_xml, patch_epub.patch 
-    epub_content = 'Zipped book content'
+    backup = epub_get.log_in_async, epub_get.fulfill_async, epub_get.generate_rights_xml, epub_get.preconnect, data.db
+    data.db = MagicMock()
+    data.db.load_fulfillment.return_value = None
+    epub_get.preconnect = MagicMock()
     rights_content = "<rights>GOD</rights>"
     book_title = "Book Title"
 
-    epub_get.log_in = MagicMock(return_value=True)
-    epub_get.fulfill = MagicMock(return_value=(book_title, "http://books.com/mybook.epub", license_token))
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, mode='w') as z:
+      z.writestr("mimetype", "application/epub+zip")
+    epub_content = buf.getvalue()
+
+    epub_get.log_in_async = AsyncMock(return_value=True)
+    epub_get.fulfill_async = AsyncMock(return_value=(book_title, "http://books.com/mybook.epub", license_token))
     epub_get.generate_rights_xml = MagicMock(return_value=rights_content)
-    patch_epub.patch = MagicMock(return_value = "{}{}".format(epub_content, rights_content))
 
-    with patch('requests.get') as mock_request:
+    self.addCleanup(os.chdir, os.getcwd())
+    with tempfile.TemporaryDirectory() as tmpdir, patch('requests.Session.get') as mock_request:
+      os.chdir(tmpdir)
       mock_request.return_value.status_code = 200
-      mock_request.return_value.text = epub_content
-      
-      with patch('builtins.open', mock_open()) as mo:
-        epub_get.get_ebook(filename)
-        mo.assert_called_with("{}.epub".format(book_title), 'wb')
-        mo().write.assert_called_with("{}{}".format(epub_content, rights_content))
-    
-      mock_request.assert_called_with('http://books.com/mybook.epub')
-    epub_get.log_in, epub_get.fulfill, epub_get.generate_rights_xml, patch_epub.patch = backup
-  
+      mock_request.return_value.headers = {}
+      mock_request.return_value.iter_content.return_value = [epub_content[:10], epub_content[10:]]
+
+      epub_filename = epub_get.get_ebook(filename)
+      self.assertEqual(epub_filename, "{}.epub".format(book_title))
+      self.assertEqual(os.listdir(tmpdir), [epub_filename])
+
+      with zipfile.ZipFile(epub_filename) as z:
+        self.assertEqual(z.read("mimetype"), b"application/epub+zip")
+        self.assertEqual(z.read("META-INF/rights.xml"), rights_content.encode())
+
+      mock_request.assert_called_with('http://books.com/mybook.epub', stream=True, headers={}, timeout=transport.DEFAULT_TIMEOUT)
+
+    epub_get.preconnect.assert_any_call("https://acs4.kobo.com/fulfillment")
+    epub_get.log_in_async, epub_get.fulfill_async, epub_get.generate_rights_xml, epub_get.preconnect, data.db = backup
+
+  def test_ledger(self):
+    d = bom.Device()
+    d.name = "local"
+
+    a = bom.Account()
+    a.urn = "toto"
+    a.devices = [d]
+
+    c = bom.Config()
+    c.current_user = "toto"
+
+    data.config = c
+    data.accounts = [a]
+
+    filename = os.path.abspath('files/fake.acsm')
+
+    license_token = etree.Element("licenseToken")
+    license_token.text = "toto"
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, mode='w') as z:
+      z.writestr("mimetype", "application/epub+zip")
+    epub_content = buf.getvalue()
+
+    backup = epub_get.log_in_and_fulfill, epub_get.preconnect, data.db
+    epub_get.log_in_and_fulfill = AsyncMock(return_value=("Book Title", "http://books.com/mybook.epub", license_token))
+    epub_get.preconnect = MagicMock()
+
+    self.addCleanup(os.chdir, os.getcwd())
+    with tempfile.TemporaryDirectory() as tmpdir, patch('requests.Session.get') as mock_request:
+      os.chdir(tmpdir)
+      data.db = db.DB(tmpdir)
+      mock_request.return_value.status_code = 200
+      mock_request.return_value.headers = {}
+      mock_request.return_value.iter_content.return_value = [epub_content]
+
+      # The same ACSM twice in a batch: fulfilled once
+      results = epub_get.get_ebooks([filename, filename])
+      self.assertEqual(epub_get.log_in_and_fulfill.call_count, 1)
+      epub_filename = "Book Title.epub"
+      r = data.find_fulfillment("toto", "urn:uuid:4", "6")
+      self.assertEqual(r.filename, os.path.abspath(epub_filename))
+      self.assertEqual([os.path.abspath(f) for _, f in results], [r.filename, r.filename])
+      self.assertEqual((r.title, r.src, r.license_token), ("Book Title", "http://books.com/mybook.epub", "<licenseToken>toto</licenseToken>"))
+
+      # Same ACSM again: nothing is requested
+      self.assertEqual(epub_get.get_ebook(filename), r.filename)
+      self.assertEqual(epub_get.log_in_and_fulfill.call_count, 1)
+
+      # The book was modified: it is downloaded again
+      with open(epub_filename, "ab") as f:
+        f.write(b"garbage")
+      self.assertEqual(epub_get.get_ebook(filename), epub_filename)
+      self.assertEqual(epub_get.log_in_and_fulfill.call_count, 2)
+
+      data.db.close()
+
+    epub_get.log_in_and_fulfill, epub_get.preconnect, data.db = backup
+
+  def test_checkpoint(self):
+    d = bom.Device()
+    d.name = "local"
+
+    a = bom.Account()
+    a.urn = "toto"
+    a.devices = [d]
+
+    c = bom.Config()
+    c.current_user = "toto"
+
+    data.config = c
+    data.accounts = [a]
+
+    filename = os.path.abspath('files/fake.acsm')
+
+    license_token = etree.Element("{http://ns.adobe.com/adept}licenseToken")
+    license_token.text = "toto"
+
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, mode='w') as z:
+      z.writestr("mimetype", "application/epub+zip")
+    epub_content = buf.getvalue()
+
+    backup = epub_get.log_in_and_fulfill, epub_get.preconnect, patch_epub.patch_file, data.db
+    epub_get.log_in_and_fulfill = AsyncMock(return_value=("Book Title", "http://books.com/mybook.epub", license_token))
+    epub_get.preconnect = MagicMock()
+    patch_file = patch_epub.patch_file
+
+    self.addCleanup(os.chdir, os.getcwd())
+    with tempfile.TemporaryDirectory() as tmpdir, patch('requests.Session.get') as mock_request:
+      os.chdir(tmpdir)
+      data.db = db.DB(tmpdir)
+      mock_request.return_value.status_code = 200
+      mock_request.return_value.headers = {}
+      mock_request.return_value.iter_content.side_effect = OSError("Connection lost")
+
+      # Interrupted during the download: the fulfillment is kept
+      self.assertIsNone(epub_get.get_ebook(filename))
+      self.assertEqual(data.find_fulfillment("toto", "urn:uuid:4", "6").stage, bom.FulfillmentRecord.FULFILLED)
+
+      # Interrupted while patching: the downloaded file is kept
+      mock_request.return_value.iter_content.side_effect = None
+      mock_request.return_value.iter_content.return_value = [epub_content]
+      patch_epub.patch_file = MagicMock(side_effect=OSError("Disk full"))
+      self.assertIsNone(epub_get.get_ebook(filename))
+      self.assertEqual(data.find_fulfillment("toto", "urn:uuid:4", "6").stage, bom.FulfillmentRecord.DOWNLOADED)
+      self.assertEqual(mock_request.call_count, 2)
+
+      # Only patching is left
+      patch_epub.patch_file = patch_file
+      epub_filename = epub_get.get_ebook(filename)
+      self.assertEqual(epub_filename, "Book Title.epub")
+      self.assertEqual(mock_request.call_count, 2)
+      self.assertEqual(epub_get.log_in_and_fulfill.call_count, 1)
+      self.assertEqual(data.find_fulfillment("toto", "urn:uuid:4", "6").stage, bom.FulfillmentRecord.DONE)
+      with zipfile.ZipFile(epub_filename) as z:
+        rights = z.read("META-INF/rights.xml")
+      self.assertIn(b"<licenseToken>toto</licenseToken>", rights)
+      self.assertEqual([x for x in os.listdir(tmpdir) if x.endswith(".part")], [])
+
+      data.db.close()
+
+    epub_get.log_in_and_fulfill, epub_get.preconnect, patch_epub.patch_file, data.db = backup
+
+  def test_auth_cache(self):
+    a = bom.Account()
+    a.urn = "toto"
+
+    backup = epub_get.log_in_async, epub_get.fulfill_async, data.db, data.auth_sessions
+    data.db = MagicMock()
+    data.auth_sessions = {}
+
+    result = ("title", "http://books.com/mybook.epub", None)
+    epub_get.log_in_async = AsyncMock(return_value=True)
+    epub_get.fulfill_async = AsyncMock(side_effect=[api_call.AuthError("E_AUTH_FAILED"), result, result])
+
+    # Cached authentication rejected by the operator: log in again, once
+    data.auth_sessions[("toto", "http://fairyland.com")] = time.time()
+    r = epub_get.aio.run(epub_get.log_in_and_fulfill(None, a, "http://fairyland.com", None))
+    self.assertEqual(r, result)
+    self.assertEqual(epub_get.log_in_async.call_count, 1)
+    data.db.delete_auth_session.assert_called_with("toto", "http://fairyland.com")
+
+    # Authentication is now cached
+    r = epub_get.aio.run(epub_get.log_in_and_fulfill(None, a, "http://fairyland.com", None))
+    self.assertEqual(r, result)
+    self.assertEqual(epub_get.log_in_async.call_count, 1)
+    self.assertEqual(epub_get.fulfill_async.call_count, 3)
+
+    epub_get.log_in_async, epub_get.fulfill_async, data.db, data.auth_sessions = backup
+
+  def test_find_acsm_files(self):
+    self.assertEqual(epub_get.find_acsm_files(["files"]), ["files/fake.acsm"])
+    self.assertEqual(epub_get.find_acsm_files(["files/*.acsm"]), ["files/fake.acsm"])
+    self.assertEqual(epub_get.find_acsm_files(["files/fake.acsm", "missing.acsm"]), ["files/fake.acsm", "missing.acsm"])
+    self.assertEqual(epub_get.find_acsm_files(["files", "./files/fake.acsm"]), ["files/fake.acsm"])
+
+  def test_get_batch(self):
+    backup = epub_get.get_ebook_async
+
+    async def fake_get(filename, deadline=None):
+      if filename == "bad.acsm":
+        return None
+      return filename + ".epub"
+
+    epub_get.get_ebook_async = AsyncMock(side_effect=fake_get)
+    results = epub_get.get_ebooks(["a.acsm", "bad.acsm", "c.acsm"], workers=2)
+    self.assertEqual(results, [("a.acsm", "a.acsm.epub"), ("bad.acsm", None), ("c.acsm", "c.acsm.epub")])
+
+    epub_get.get_ebook_async = backup
+
 
 if __name__ == '__main__':
   unittest.main()
@@ -1,13 +1,15 @@
-from context import login, account, utils, db, data, bom
+from context import login, account, utils, db, data, bom, keypool
 from unittest.mock import patch, MagicMock
 import unittest
 import base64
 import os
+import tempfile
+import asyncio
 
 class TestLogin(unittest.TestCase):
   def test_actinfo_ok(self):
     reply = b'<activationServiceInfo xmlns="http://ns.adobe.com/adept"><authURL>http://adeactivate.adobe.com/adept</authURL><userInfoURL>http://adeactivate.adobe.com/adept</userInfoURL><certificate>TOTO</certificate></activationServiceInfo>'
-    with patch('requests.get') as mock_request:
+    with patch('requests.Session.get') as mock_request:
       mock_request.return_value.status_code = 200
       mock_request.return_value.text = reply
 
@@ -18,7 +20,7 @@ class TestLogin(unittest.TestCase):
 
   def test_authinfo_ok(self):
     reply = b'<authenticationServiceInfo xmlns="http://ns.adobe.com/adept"><authURL>http://adeactivate.adobe.com/adept</authURL><certificate>TITI</certificate><signInMethods><signInMethod method="AdobeID" type="direct">Adobe ID</signInMethod><signInMethod method="anonymous" type="direct">anonymous</signInMethod></signInMethods></authenticationServiceInfo>'
-    with patch('requests.get') as mock_request:
+    with patch('requests.Session.get') as mock_request:
       mock_request.return_value.status_code = 200
       mock_request.return_value.text = reply
 
@@ -44,7 +46,7 @@ class TestLogin(unittest.TestCase):
     data.config = c
     data.accounts = [a]
 
-    with patch('requests.post') as mock_request:
+    with patch('requests.Session.post') as mock_request:
       mock_request.return_value.status_code = 200
       mock_request.return_value.text = reply
 
@@ -52,5 +54,86 @@ class TestLogin(unittest.TestCase):
       self.assertEqual(a.urn, "urn:uuid:563084fa-6c5c-4489-b8a6-b9e053dcbb7c")
       mock_request.assert_called()
 
+  def test_bootstrap(self):
+    store = MagicMock()
+    store.config = None
+    acc = bom.Account()
+    acc.urn = "urn:a"
+
+    # Both service info requests are in flight at the same time
+    in_flight = []
+    async def fake_call(reply):
+      in_flight.append(1)
+      await asyncio.sleep(0.05)
+      self.assertEqual(len(in_flight), 2)
+      return reply
+
+    with patch.object(login, "data", store), \
+         patch.object(login, "provision", return_value=acc) as provision, \
+         patch.object(login.ActivationInit, "call_async", lambda s: fake_call(("auth", "userinfo", "ACTCERT"))), \
+         patch.object(login.AuthenticationInit, "call_async", lambda s: fake_call("AUTHCERT")):
+      with self.assertLogs(level="DEBUG") as logs:
+        login.login(None, None)
+
+    config = store.store_config.call_args[0][0]
+    self.assertEqual((config.auth_url, config.activation_certificate, config.authentication_certificate), ("auth", "ACTCERT", "AUTHCERT"))
+    provision.assert_called_once()
+    store.set_current_account.assert_called_once_with("urn:a")
+    for step in ["Activation service info", "Authentication service info", "Key generation", "Login"]:
+      self.assertTrue(any(step + " took" in l for l in logs.output), step)
+
+  def test_read_credentials(self):
+    with tempfile.TemporaryDirectory() as tmp:
+      filename = os.path.join(tmp, "accounts.txt")
+      with open(filename, "w") as f:
+        f.write("# test accounts\ntoto@adobe.com SuP3R S3cr3t\n\nanonymous\n")
+      credentials = login.read_credentials(filename)
+    self.assertEqual(credentials, [("toto@adobe.com", "SuP3R S3cr3t"), (None, None)])
+
+  def test_key_pool(self):
+    pool = keypool.KeyPool(2, 1)
+    try:
+      pairs = [pool.get() for i in range(3)]
+    finally:
+      pool.close()
+    self.assertEqual(len(set(pairs)), 3)
+    for private_key, public_key in pairs:
+      self.assertTrue(len(base64.b64decode(private_key)) > 0)
+
+  def test_login_batch(self):
+    def fake_provision(user, password, key_pool):
+      if user == "fail":
+        return None
+      d = bom.Device()
+      d.name = "local"
+      d.device_key = b"S0VZ"
+      d.device_id = "urn:device:" + user
+      a = bom.Account()
+      a.urn = "urn:" + user
+      a.sign_id = user
+      a.devices = [d]
+      return a
+
+    with tempfile.TemporaryDirectory() as tmp:
+      store = db.DBData()
+      store.db.db_path = tmp
+      store.config = bom.Config()
+      store.db.store_config(store.config)
+
+      with patch.object(login, "data", store), \
+           patch.object(login, "init_config"), \
+           patch.object(login, "provision", side_effect=fake_provision), \
+           patch.object(login, "KeyPool"):
+        results = login.login_batch([("a", "1"), ("fail", "2"), ("b", "3")], workers=2)
+
+      self.assertEqual([(u, a.urn if a else None) for u, a in results], [("a", "urn:a"), ("fail", None), ("b", "urn:b")])
+      self.assertEqual(store.config.current_user, "urn:a")
+
+      # Both accounts and their devices reached the database
+      accounts = store.db.load_accounts()
+      store.db.close()
+      self.assertEqual(sorted(a.urn for a in accounts), ["urn:a", "urn:b"])
+      self.assertEqual(sorted(a.devices[0].device_id for a in accounts), ["urn:device:a", "urn:device:b"])
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,108 @@
+from context import patch_epub
+
+import unittest
+import io
+import os
+import tempfile
+import zipfile
+from unittest.mock import patch
+
+RIGHTS = b'<?xml version="1.0"?>\n<rights xmlns="http://ns.adobe.com/adept"/>'
+
+class TestPatchEpub(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmp.cleanup)
+    self.filename = os.path.join(self.tmp.name, "book.epub")
+
+  def make_epub(self, comment=b""):
+    with zipfile.ZipFile(self.filename, mode='w') as z:
+      z.writestr("mimetype", "application/epub+zip")
+      z.writestr("OEBPS/content.xhtml", "<html>" + "text " * 1000 + "</html>", compress_type=zipfile.ZIP_DEFLATED)
+      z.comment = comment
+    with open(self.filename, "rb") as f:
+      return f.read()
+
+  def check(self, names):
+    with zipfile.ZipFile(self.filename) as z:
+      self.assertIsNone(z.testzip())
+      self.assertEqual(z.namelist(), names)
+      self.assertEqual(z.read(patch_epub.RIGHTS_FILENAME), RIGHTS)
+      return z.comment
+
+  def test_patch_file(self):
+    original = self.make_epub(comment=b"A comment")
+    with zipfile.ZipFile(self.filename) as z:
+      cd_offset = z.start_dir
+
+    patch_epub.patch_file(self.filename, RIGHTS.decode())
+
+    comment = self.check(["mimetype", "OEBPS/content.xhtml", patch_epub.RIGHTS_FILENAME])
+    self.assertEqual(comment, b"A comment")
+    # The entries are not rewritten
+    with open(self.filename, "rb") as f:
+      self.assertEqual(f.read(cd_offset), original[:cd_offset])
+
+  def test_patch(self):
+    original = self.make_epub()
+    patched = patch_epub.patch(original, RIGHTS)
+    patch_epub.patch_file(self.filename, RIGHTS)
+    with open(self.filename, "rb") as f:
+      self.assertEqual(len(f.read()), len(patched))
+    with zipfile.ZipFile(io.BytesIO(patched)) as z:
+      self.assertEqual(z.read(patch_epub.RIGHTS_FILENAME), RIGHTS)
+
+  def test_zip64(self):
+    self.make_epub()
+    # As if the archive was bigger than 2 GiB, with more than 65535 entries
+    with patch.object(patch_epub, "ZIP64_LIMIT", 100), patch.object(patch_epub, "ZIP_FILECOUNT_LIMIT", 2):
+      patch_epub.patch_file(self.filename, RIGHTS)
+    with open(self.filename, "rb") as f:
+      content = f.read()
+    self.assertIn(patch_epub.ZIP64_END_RECORD_SIGNATURE, content)
+    self.assertIn(patch_epub.ZIP64_LOCATOR_SIGNATURE, content)
+    self.check(["mimetype", "OEBPS/content.xhtml", patch_epub.RIGHTS_FILENAME])
+
+    # Zip64 end records are read back
+    with open(self.filename, "r+b") as f:
+      patch_epub.set_entry(f, "META-INF/encryption.xml", b"<encryption/>")
+    self.check(["mimetype", "OEBPS/content.xhtml", patch_epub.RIGHTS_FILENAME, "META-INF/encryption.xml"])
+
+  def test_replace(self):
+    self.make_epub()
+    patch_epub.patch_file(self.filename, b"<rights/>")
+    size = os.path.getsize(self.filename)
+
+    # The last entry is written over
+    patch_epub.patch_file(self.filename, RIGHTS)
+    self.check(["mimetype", "OEBPS/content.xhtml", patch_epub.RIGHTS_FILENAME])
+    self.assertEqual(os.path.getsize(self.filename), size + len(RIGHTS) - len(b"<rights/>"))
+
+    # Other entries follow it: it is only dropped from the central directory
+    with zipfile.ZipFile(self.filename, mode='a') as z:
+      z.writestr("OEBPS/other.xhtml", "<html/>")
+    with open(self.filename, "rb") as f:
+      tail = patch_epub.read_tail(f)
+    patch_epub.patch_file(self.filename, RIGHTS)
+    self.check(["mimetype", "OEBPS/content.xhtml", "OEBPS/other.xhtml", patch_epub.RIGHTS_FILENAME])
+    with open(self.filename, "rb") as f:
+      self.assertEqual(patch_epub.read_tail(f).cd_offset, tail.cd_offset + patch_epub.LOCAL_HEADER.size + len(patch_epub.RIGHTS_FILENAME) + len(RIGHTS))
+
+  def test_prefixed_archive(self):
+    # Data before the archive, e.g. a self-extracting archive
+    original = self.make_epub()
+    with open(self.filename, "wb") as f:
+      f.write(b"#!/bin/sh\n" + original)
+    patch_epub.patch_file(self.filename, b"<rights/>")
+    patch_epub.patch_file(self.filename, RIGHTS)
+    self.check(["mimetype", "OEBPS/content.xhtml", patch_epub.RIGHTS_FILENAME])
+    with open(self.filename, "rb") as f:
+      self.assertEqual(f.read(10), b"#!/bin/sh\n")
+
+  def test_not_a_zip(self):
+    with open(self.filename, "wb") as f:
+      f.write(b"not a zip file")
+    self.assertRaises(zipfile.BadZipFile, patch_epub.patch_file, self.filename, RIGHTS)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,88 @@
+from context import api_call, retry
+from unittest.mock import MagicMock
+import unittest
+import requests
+
+def response(status, text=""):
+  r = MagicMock()
+  r.status_code = status
+  r.text = text
+  if status >= 400:
+    r.raise_for_status.side_effect = requests.exceptions.HTTPError(response=r)
+  return r
+
+class TestRetry(unittest.TestCase):
+  def make_call(self, cls, *replies):
+    if cls is api_call.SignInDirect:
+      call = cls("anonymous", None, None, None)
+    elif cls is api_call.InitLicense:
+      call = cls("http://operator.com", None)
+    elif cls is api_call.Fulfillment:
+      call = cls(None, None, "http://operator.com")
+    else:
+      call = cls()
+    call.transport = MagicMock()
+    call.transport.timeout = (1, 2)
+    call.transport.get.side_effect = list(replies)
+    call.transport.post.side_effect = list(replies)
+    call.retry_policy = retry.RetryPolicy(attempts=3, base_delay=0)
+    return call
+
+  def test_transient_http_error(self):
+    reply = '<authenticationServiceInfo xmlns="http://ns.adobe.com/adept"><certificate>TITI</certificate></authenticationServiceInfo>'
+    call = self.make_call(api_call.AuthenticationInit, response(503), response(200, reply))
+    self.assertEqual(call.call(), "TITI")
+    self.assertEqual(call.transport.get.call_count, 2)
+
+  def test_give_up(self):
+    call = self.make_call(api_call.AuthenticationInit, response(500), response(502), response(504), response(200))
+    self.assertIsNone(call.call())
+    self.assertEqual(call.transport.get.call_count, 3)
+
+  def test_not_idempotent(self):
+    # The request may have been processed: do not send it twice
+    call = self.make_call(api_call.SignInDirect, requests.exceptions.ReadTimeout(), response(200))
+    call.build = MagicMock(return_value=b"<signIn/>")
+    success, _, _, _, _ = call.call()
+    self.assertFalse(success)
+    self.assertEqual(call.transport.post.call_count, 1)
+
+    call = self.make_call(api_call.SignInDirect, requests.exceptions.ConnectTimeout(), response(503), response(200, '<error xmlns="http://ns.adobe.com/adept" data="E_AUTH_FAILED"/>'))
+    call.build = MagicMock(return_value=b"<signIn/>")
+    call.call()
+    self.assertEqual(call.transport.post.call_count, 3)
+
+  def test_adept_errors(self):
+    expired = '<error xmlns="http://ns.adobe.com/adept" data="E_ADEPT_REQUEST_EXPIRED http://x"/>'
+    failed = '<error xmlns="http://ns.adobe.com/adept" data="E_AUTH_FAILED http://x"/>'
+
+    call = self.make_call(api_call.InitLicense, response(200, expired), response(200, failed), response(200, failed))
+    call.build = MagicMock(return_value=b"<licenseServiceRequest/>")
+    self.assertFalse(call.call())
+    # Rebuilt after the transient error, not after the permanent one
+    self.assertEqual(call.build.call_count, 2)
+    self.assertEqual(call.transport.post.call_count, 2)
+
+    # Without its own nonce, an expired request is an expired ACSM: permanent
+    call = self.make_call(api_call.Fulfillment, response(200, expired), response(200, failed))
+    call.build = MagicMock(return_value=b"<fulfill/>")
+    self.assertEqual(call.call(), (None, None, None))
+    self.assertEqual(call.error, "E_ADEPT_REQUEST_EXPIRED http://x")
+    self.assertEqual(call.transport.post.call_count, 1)
+
+  def test_deadline(self):
+    call = self.make_call(api_call.AuthenticationInit, response(503), response(200))
+    call.retry_policy = retry.RetryPolicy(attempts=3)
+    call.retry_policy.backoff = MagicMock(return_value=10)
+
+    token = retry.current_deadline.set(retry.Deadline(0.5))
+    try:
+      self.assertIsNone(call.call())
+    finally:
+      retry.current_deadline.reset(token)
+
+    self.assertEqual(call.transport.get.call_count, 1)
+    self.assertLessEqual(call.transport.get.call_args[1]["timeout"][0], 0.5)
+
+if __name__ == '__main__':
+  unittest.main()
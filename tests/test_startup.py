@@ -0,0 +1,53 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+# Only the commands using the network need them
+HEAVY_MODULES = ["lxml", "requests", "cryptography", "ctypes", "asyncio"]
+
+# Generous: the import of adl takes about 10 ms, against 60 ms with the
+# modules above
+IMPORT_BUDGET_US = 200000
+
+class TestStartup(unittest.TestCase):
+  def setUp(self):
+    self.tmp = tempfile.TemporaryDirectory()
+    self.addCleanup(self.tmp.cleanup)
+
+  def import_times(self, *command):
+    # Cumulative import time of each module, in us, from -X importtime
+    env = dict(os.environ, HOME=self.tmp.name)
+    for name in ["ADL_DATA_DIR", "ADL_TENANT", "ADL_SHARDS"]:
+      env.pop(name, None)
+    result = subprocess.run([sys.executable, "-X", "importtime", os.path.join(ROOT, "adl.py")] + list(command),
+                            env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    self.assertEqual(result.returncode, 0, result.stderr)
+
+    times = {}
+    for line in result.stderr.splitlines():
+      fields = line[len("import time:"):].split("|")
+      if line.startswith("import time:") and len(fields) == 3 and fields[1].strip().isdigit():
+        times[fields[2].strip()] = int(fields[1])
+    return times
+
+  def test_help(self):
+    times = self.import_times("--help")
+    for module in HEAVY_MODULES:
+      self.assertNotIn(module, times)
+    self.assertLess(times["adl"], IMPORT_BUDGET_US)
+    # No data is read to print the help
+    self.assertFalse(os.path.exists(os.path.join(self.tmp.name, ".adl")))
+
+  def test_account_list(self):
+    times = self.import_times("account", "list")
+    for module in HEAVY_MODULES:
+      self.assertNotIn(module, times)
+    self.assertNotIn("adl.login", times)
+    self.assertLess(times["adl"], IMPORT_BUDGET_US)
+
+if __name__ == '__main__':
+  unittest.main()
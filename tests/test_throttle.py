@@ -0,0 +1,120 @@
+from context import throttle, retry
+from unittest.mock import MagicMock
+import unittest
+import threading
+import time
+import requests
+
+def ok():
+  r = MagicMock()
+  r.status_code = 200
+  return r
+
+def unavailable():
+  r = MagicMock()
+  r.status_code = 503
+  return r
+
+def refused():
+  raise requests.exceptions.ConnectionError()
+
+class TestThrottle(unittest.TestCase):
+  def test_circuit_breaker(self):
+    t = throttle.Throttle(failure_threshold=2, cooldown=0.2)
+    url = "http://operator.com/Fulfill"
+
+    t.request(url, unavailable)
+    self.assertRaises(requests.exceptions.ConnectionError, t.request, url, refused)
+
+    # Open: nothing is sent
+    send = MagicMock(side_effect=ok)
+    self.assertRaises(throttle.CircuitOpenError, t.request, url, send)
+    send.assert_not_called()
+
+    # Other hosts are not affected
+    t.request("http://adeactivate.adobe.com/adept/Activate", send)
+    self.assertEqual(send.call_count, 1)
+
+    # Probe after the cooldown, then close
+    time.sleep(0.25)
+    t.request(url, send)
+    self.assertEqual(send.call_count, 2)
+    self.assertEqual(t.get_host(url).breaker.state, throttle.CircuitBreaker.CLOSED)
+
+  def test_failed_probe(self):
+    t = throttle.Throttle(failure_threshold=1, cooldown=0.1)
+    url = "http://operator.com/Fulfill"
+
+    t.request(url, unavailable)
+    time.sleep(0.15)
+    t.request(url, unavailable)
+    self.assertRaises(throttle.CircuitOpenError, t.request, url, ok)
+
+  def test_concurrency(self):
+    t = throttle.Throttle(max_concurrency=2)
+    url = "http://operator.com/Fulfill"
+    lock = threading.Lock()
+    in_flight = []
+    max_in_flight = []
+
+    def send():
+      with lock:
+        in_flight.append(1)
+        max_in_flight.append(len(in_flight))
+      time.sleep(0.02)
+      with lock:
+        in_flight.pop()
+      return ok()
+
+    threads = [threading.Thread(target=t.request, args=(url, send)) for i in range(8)]
+    for th in threads:
+      th.start()
+    for th in threads:
+      th.join()
+    self.assertEqual(max(max_in_flight), 2)
+
+  def test_rate(self):
+    t = throttle.Throttle(rate=50, burst=1)
+    start = time.monotonic()
+    for i in range(6):
+      t.request("http://operator.com/Fulfill", ok)
+    self.assertGreaterEqual(time.monotonic() - start, 0.09)
+
+  def test_deadline(self):
+    t = throttle.Throttle(max_concurrency=1, rate=1, burst=1)
+    url = "http://operator.com/Fulfill"
+    t.request(url, ok)
+
+    token = retry.current_deadline.set(retry.Deadline(0.1))
+    self.addCleanup(retry.current_deadline.reset, token)
+    # The next token comes after the deadline
+    start = time.monotonic()
+    self.assertRaises(retry.DeadlineExceeded, t.request, url, ok)
+    self.assertLess(time.monotonic() - start, 0.5)
+
+    # All the slots of the host are taken until after the deadline
+    t.get_host(url).semaphore.acquire()
+    self.assertRaises(retry.DeadlineExceeded, t.request, url, ok)
+
+  def test_probe_deadline(self):
+    t = throttle.Throttle(max_concurrency=1, failure_threshold=1, cooldown=0.05)
+    url = "http://operator.com/Fulfill"
+    t.request(url, unavailable)
+    time.sleep(0.1)
+
+    # The probe cannot get a slot before its deadline
+    limiter = t.get_host(url)
+    limiter.semaphore.acquire()
+    token = retry.current_deadline.set(retry.Deadline(0.1))
+    try:
+      self.assertRaises(retry.DeadlineExceeded, t.request, url, ok)
+    finally:
+      retry.current_deadline.reset(token)
+      limiter.semaphore.release()
+
+    # The next request probes the host
+    t.request(url, ok)
+    self.assertEqual(limiter.breaker.state, throttle.CircuitBreaker.CLOSED)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,93 @@
+from context import api_call, transport, throttle
+from unittest.mock import MagicMock
+import unittest
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header("Content-Length", "2")
+    self.end_headers()
+    self.wfile.write(b"ok")
+
+  def do_HEAD(self):
+    self.send_response(200)
+    self.send_header("Content-Length", "2")
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+class CountingServer(ThreadingHTTPServer):
+  connections = 0
+
+  def process_request(self, request, client_address):
+    self.connections += 1
+    ThreadingHTTPServer.process_request(self, request, client_address)
+
+class TestTransport(unittest.TestCase):
+  def test_shared_transport(self):
+    t1 = transport.get_transport()
+    t2 = transport.get_transport()
+    self.assertIs(t1, t2)
+
+    call = api_call.ActivationInit()
+    self.assertIs(call.get_transport(), t1)
+
+  def test_configure(self):
+    # The other tests keep using the transport in place, which configure would close
+    self.addCleanup(setattr, transport, "_default", transport._default)
+    transport._default = None
+    t = transport.configure(pool_connections=2, pool_maxsize=4)
+    self.addCleanup(t.close)
+    self.assertIs(transport.get_transport(), t)
+    adapter = t.session.get_adapter("https://adeactivate.adobe.com")
+    self.assertEqual(adapter._pool_maxsize, 4)
+    self.assertEqual(adapter._pool_connections, 2)
+
+  def test_injection(self):
+    t = MagicMock()
+    t.get.return_value.text = "<reply/>"
+
+    call = api_call.AuthenticationInit()
+    call.transport = t
+    call.send(call.get_url(), None)
+    t.get.assert_called_with("http://adeactivate.adobe.com/adept/AuthenticationServiceInfo", timeout=t.timeout)
+
+  def test_preconnect(self):
+    server = CountingServer(("127.0.0.1", 0), KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = "http://127.0.0.1:{}/fulfillment".format(server.server_port)
+
+    t = transport.Transport()
+    t.preconnect(url)
+    for i in range(100):
+      if server.connections == 1:
+        break
+      time.sleep(0.01)
+    self.assertEqual(server.connections, 1)
+
+    r = t.get(url)
+    self.assertEqual(r.text, "ok")
+
+    # The request used the connection opened in advance
+    self.assertEqual(server.connections, 1)
+
+    # No connection to a failing host
+    t.close()
+    t = transport.Transport()
+    t.throttle.get_host(url).breaker.state = throttle.CircuitBreaker.OPEN
+    t.preconnect(url)
+    time.sleep(0.05)
+    self.assertEqual(server.connections, 1)
+
+    t.close()
+    server.shutdown()
+    server.server_close()
+
+if __name__ == '__main__':
+  unittest.main()
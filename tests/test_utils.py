@@ -1,4 +1,4 @@
-from context import account, utils
+from context import account, utils, keycache, bom
 from unittest.mock import patch, MagicMock
 import unittest
 import base64
@@ -22,5 +22,45 @@ class TestUtils(unittest.TestCase):
   def test_generate_key(self):
     prvk, pubk = utils.generate_key_pair()
 
+  def test_key_cache(self):
+    cache = keycache.KeyCache(max_entries=2, ttl=100)
+    loader = MagicMock(side_effect=lambda: "key")
+
+    self.assertEqual(cache.get(("urn:1", "pk"), loader), "key")
+    self.assertEqual(cache.get(("urn:1", "pk"), loader), "key")
+    self.assertEqual(loader.call_count, 1)
+
+    # Least recently used entry is evicted
+    cache.get(("urn:2", "pk"), loader)
+    cache.get(("urn:1", "pk"), loader)
+    cache.get(("urn:3", "pk"), loader)
+    self.assertEqual(loader.call_count, 3)
+    self.assertIn(("urn:1", "pk"), cache.entries)
+    self.assertNotIn(("urn:2", "pk"), cache.entries)
+
+    cache.invalidate("urn:1")
+    self.assertEqual(list(cache.entries.keys()), [("urn:3", "pk")])
+
+    cache.ttl = 0
+    cache.get(("urn:3", "pk"), loader)
+    self.assertEqual(loader.call_count, 4)
+
+  def test_pkcs12_cache(self):
+    a = bom.Account()
+    a.urn = "urn:pkcs12"
+    a.pkcs12 = "UEtDUzEy"
+
+    pk, cert = MagicMock(), MagicMock()
+    pk.private_bytes.return_value = b"PK"
+    cert.public_bytes.return_value = b"CERT"
+    with patch('cryptography.hazmat.primitives.serialization.pkcs12.load_key_and_certificates', return_value=(pk, cert, None)) as load:
+      self.assertEqual(utils.extract_pk_from_pkcs12(a, b"KEY"), b"PK")
+      self.assertEqual(utils.extract_cert_from_pkcs12(a, b"KEY"), b"CERT")
+      self.assertEqual(load.call_count, 1)
+
+      keycache.key_cache.invalidate(a.urn)
+      utils.extract_pk_from_pkcs12(a, b"KEY")
+      self.assertEqual(load.call_count, 2)
+
 if __name__ == '__main__':
   unittest.main()